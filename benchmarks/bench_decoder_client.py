@@ -0,0 +1,128 @@
+#!venv/bin/python3
+"""
+Benchmark of the HTTP client used by message_processor for the decoder API.
+
+Starts a stub of decoders_api.js (answers /decrypt/hex and /decode/hex
+immediately) on TCP and on a Unix domain socket and measures messages per
+second, each message being one decrypt and one decode call, for:
+
+  requests.post   a new connection per call, as message_processor did before
+  pooled TCP      message_processor.create_session() (keep-alive, retries)
+  pooled Unix     the same over DECODER_SOCKET
+
+Run from the repository root:
+    venv/bin/python3 benchmarks/bench_decoder_client.py [messages]
+"""
+
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import message_processor  # noqa: E402
+
+MESSAGES = 2000
+DECRYPT = {"payload": "40f17dbe4900020001954378762b11ff0d"}
+DECODE = {"payload": "74657374", "application": "a", "device": "d"}
+
+
+class StubDecoder(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like express
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/decrypt/"):
+            body = json.dumps("74657374").encode()
+        else:
+            body = json.dumps({"data": {"text": "test"}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TcpStubDecoder(StubDecoder):
+    # headers and body are written separately; express sends one segment
+    disable_nagle_algorithm = True
+
+
+class UnixStubServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects an (host, port) client address
+        return request, ("local", 0)
+
+
+def _serve(server) -> None:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def _run(label: str, post, base_url: str, messages: int) -> None:
+    start = time.perf_counter()
+    for _ in range(messages):
+        post(f"{base_url}/decrypt/hex", DECRYPT).raise_for_status()
+        post(f"{base_url}/decode/hex", DECODE).raise_for_status()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<14} {messages / elapsed:>9.0f} msg/s"
+        f" {elapsed / messages * 1e3:>8.3f} ms/msg"
+    )
+
+
+def main() -> None:
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    tcp_server = ThreadingHTTPServer(("127.0.0.1", 0), TcpStubDecoder)
+    tcp_server.daemon_threads = True
+    _serve(tcp_server)
+    base_url = f"http://127.0.0.1:{tcp_server.server_address[1]}"
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "decoder.sock")
+    unix_server = UnixStubServer(socket_path, StubDecoder)
+    _serve(unix_server)
+
+    timeout = message_processor.DECODER_TIMEOUT
+    tcp_session = message_processor.create_session(None)
+    unix_session = message_processor.create_session(socket_path)
+
+    print(f"{messages} messages, 2 calls each")
+    _run(
+        "requests.post",
+        lambda url, payload: requests.post(url, json=payload),
+        base_url,
+        messages,
+    )
+    _run(
+        "pooled TCP",
+        lambda url, payload: tcp_session.post(
+            url, json=payload, timeout=timeout
+        ),
+        base_url,
+        messages,
+    )
+    _run(
+        "pooled Unix",
+        lambda url, payload: unix_session.post(
+            url, json=payload, timeout=timeout
+        ),
+        "http://decoder",
+        messages,
+    )
+    os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    main()
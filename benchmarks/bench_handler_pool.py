@@ -0,0 +1,187 @@
+#!venv/bin/python3
+"""
+Benchmark of the message_handler worker pool (HANDLER_WORKERS).
+
+Feeds uplinks of several devices through message_handler.build_message
+against a stub of decoders_api.js that answers /decrypt and /decode after a
+configurable latency, and stores the results in a temporary messages.db.
+The inline loop (HANDLER_WORKERS=1) is compared with WorkerPool lanes; the
+per-device order of the stored messages is checked for every run.
+
+Run from the repository root:
+    venv/bin/python3 benchmarks/bench_handler_pool.py --latency 20
+"""
+
+import argparse
+import base64
+import json
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TEMP_DIR = tempfile.mkdtemp()
+os.environ["DB_DIR"] = TEMP_DIR
+os.environ["DECRYPTER"] = "node"  # both decoder calls go to the stub
+os.environ["HANDLER_WORKERS"] = "16"  # connection pool size
+# the stub answers the same payload every time; measure the lanes, not hits
+os.environ["DECODE_CACHE_SIZE"] = "0"
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import message_database  # noqa: E402
+import message_handler  # noqa: E402
+import message_processor  # noqa: E402
+
+
+class SlowDecoder(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        if self.path.startswith("/decrypt/"):
+            body = json.dumps("74657374").encode()
+        else:
+            body = json.dumps({"data": {"text": "test"}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _dev_addr(device: int) -> int:
+    return 0x26000000 | device  # NwkID 19 (TTN)
+
+
+def _create_sessions(devices: int) -> None:
+    with sqlite3.connect(message_processor.session_index._db_file) as conn:
+        conn.execute("""
+            CREATE TABLE device_sessions (
+                dev_eui TEXT, application_id TEXT, device_id TEXT,
+                started_at TEXT, dev_addr TEXT, app_s_key TEXT,
+                nwk_s_key TEXT, up_formatter TEXT
+            )
+            """)
+        conn.executemany(
+            "INSERT INTO device_sessions VALUES (?, ?, ?, ?, ?, ?, ?, NULL)",
+            [
+                (
+                    f"{_device:016X}",
+                    "bench",
+                    f"device-{_device}",
+                    "2026-01-01T00:00:00Z",
+                    f"{_dev_addr(_device):08X}",
+                    "00" * 16,
+                    "00" * 16,
+                )
+                for _device in range(devices)
+            ],
+        )
+
+
+def _packets(messages: int, devices: int) -> list[dict]:
+    packets = []
+    for index in range(messages):
+        device = index % devices
+        frame = (
+            b"\x40"
+            + struct.pack("<IBH", _dev_addr(device), 0, index // devices)
+            + b"\x01"
+            + os.urandom(4)
+            + os.urandom(4)
+        )
+        packets.append(
+            {
+                "data": base64.b64encode(frame).decode(),
+                "gateway_eui": f"{index:016x}",  # unique primary key
+            }
+        )
+    return packets
+
+
+class Store:
+    """Inserts like store_message, without the Redis publish."""
+
+    def __init__(self) -> None:
+        self.stored: list[dict] = []
+
+    def __call__(self, message: dict) -> None:
+        message_database.insert_message(
+            message["receiveTimestamp"],
+            message["gatewayEui"],
+            json.dumps(message),
+        )
+        self.stored.append(message)
+
+    def in_order(self) -> bool:
+        last: dict[str, int] = {}
+        for message in self.stored:
+            if message["fCnt"] < last.get(message["devAddr"], -1):
+                return False
+            last[message["devAddr"]] = message["fCnt"]
+        return True
+
+
+def _report(label: str, store: Store, elapsed: float) -> None:
+    rate = len(store.stored) / elapsed
+    order = "ok" if store.in_order() else "VIOLATED"
+    print(f"{label:<10} {rate:>9.1f} msg/s   per-device order {order}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--latency", type=float, default=20.0, help="ms per decoder call"
+    )
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument(
+        "--workers", default="2,4,8,16", help="comma-separated lane counts"
+    )
+    args = parser.parse_args()
+
+    SlowDecoder.latency = args.latency / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowDecoder)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    message_processor.BASE_URL = f"http://127.0.0.1:{server.server_port}"
+
+    _create_sessions(args.devices)
+    message_database.create_database()
+    packets = _packets(args.messages, args.devices)
+    print(
+        f"{args.messages} messages of {args.devices} devices, "
+        f"{args.latency:.0f} ms per decoder call"
+    )
+
+    store = Store()
+    start = time.perf_counter()
+    for packet in packets:
+        message = message_handler.build_message(packet, time.time())
+        if message is not None:
+            store(message)
+    _report("inline", store, time.perf_counter() - start)
+
+    for workers in map(int, args.workers.split(",")):
+        store = Store()
+        pool = message_handler.WorkerPool(workers, store=store)
+        start = time.perf_counter()
+        for packet in packets:
+            pool.submit(packet)
+        pool.wait()
+        _report(f"{workers} lanes", store, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
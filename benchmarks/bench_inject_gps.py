@@ -0,0 +1,117 @@
+#!venv/bin/python3
+"""
+Micro-benchmark for GWMPMultiplexer._inject_gps.
+
+Compares the stat splicing fast path with the previous full JSON round-trip
+on PUSH_DATA frames shaped like lora_pkt_fwd output, with 1–8 rxpk entries,
+with and without a stat object.
+
+Run from the repository root:
+    venv/bin/python3 benchmarks/bench_inject_gps.py
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import gwmp_mux  # noqa: E402
+
+NUMBER = 20000
+HEADER = b"\x02\x12\x34\x00" + bytes.fromhex("aabbccfffe001122")
+POSITION = {"lat": 52.520008, "lon": 13.404954, "alt": 34.2}
+
+
+def _rxpk(index: int) -> dict:
+    return {
+        "jver": 1,
+        "tmst": 1293718860 + index * 1000,
+        "time": "2026-10-18T10:00:00.123456Z",
+        "tmms": 1444730418123,
+        "chan": index % 8,
+        "rfch": index % 2,
+        "freq": 867.1 + 0.2 * (index % 8),
+        "mid": 8,
+        "stat": 1,
+        "modu": "LORA",
+        "datr": "SF7BW125",
+        "codr": "4/5",
+        "rssis": -97,
+        "lsnr": 7.5,
+        "foff": -1234,
+        "rssi": -96,
+        "size": 23,
+        "data": base64.b64encode(os.urandom(23)).decode(),
+    }
+
+
+_STAT = {
+    "time": "2026-10-18 10:00:00 GMT",
+    "lati": 52.0,
+    "long": 13.0,
+    "alti": 30,
+    "rxnb": 4,
+    "rxok": 4,
+    "rxfw": 4,
+    "ackr": 100.0,
+    "dwnb": 0,
+    "txnb": 0,
+    "temp": 38.5,
+}
+
+
+def _frame(rxpk_count: int, with_stat: bool) -> bytes:
+    payload = {"rxpk": [_rxpk(i) for i in range(rxpk_count)]}
+    if with_stat:
+        payload["stat"] = _STAT
+    return HEADER + json.dumps(payload, separators=(",", ":")).encode()
+
+
+def _old_path(mux, data: bytes) -> bytes:
+    """_inject_gps as it was before the byte-level fast path."""
+    pos = mux._gps.position()
+    if pos is None:
+        return data
+    return mux._inject_gps_json(data, pos)
+
+
+def main() -> None:
+    gps = gwmp_mux.GpsProvider(max_age=0)
+    gps._update(json.dumps({**POSITION, "utc": time.time()}))
+    assert gps.position() is not None, "no GPS fix, nothing is injected"
+    mux = object.__new__(gwmp_mux.GWMPMultiplexer)  # no sockets needed
+    mux._gps = gps
+
+    print(
+        f"{'rxpk':>4} {'stat':>5} {'old µs':>8} {'new µs':>8} {'speedup':>8}"
+    )
+    for rxpk_count in (1, 2, 4, 8):
+        for with_stat in (False, True):
+            frame = _frame(rxpk_count, with_stat)
+            injected = mux._inject_gps(frame)
+            assert json.loads(injected[12:]) == json.loads(
+                _old_path(mux, frame)[12:]
+            )
+            if with_stat:
+                assert injected != frame
+                stat = json.loads(injected[12:])["stat"]
+                assert stat["lati"] == POSITION["lat"]
+                assert stat["long"] == POSITION["lon"]
+                assert stat["alti"] == round(POSITION["alt"])
+            else:
+                assert injected == frame  # nothing to inject into
+            old = timeit.timeit(lambda: _old_path(mux, frame), number=NUMBER)
+            new = timeit.timeit(lambda: mux._inject_gps(frame), number=NUMBER)
+            print(
+                f"{rxpk_count:>4} {str(with_stat):>5}"
+                f" {old / NUMBER * 1e6:>8.2f} {new / NUMBER * 1e6:>8.2f}"
+                f" {old / new:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
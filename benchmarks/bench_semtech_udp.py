@@ -0,0 +1,124 @@
+#!venv/bin/python3
+"""
+Micro-benchmark for the semtech_udp parsers of message_collector.
+
+Compares process_message (header dict, json.loads of the payload copy) with
+parse_header_fast + iter_rxpk (slotted header, orjson on a memoryview) for
+PUSH_DATA frames. The frames are taken from a gwmp_mux capture file if one
+is given, otherwise synthetic frames with 1–8 rxpk entries are used.
+
+Run from the repository root:
+    venv/bin/python3 benchmarks/bench_semtech_udp.py [capture.bin]
+"""
+
+import base64
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "message_collector")
+)
+
+import gwmp_capture  # noqa: E402
+import semtech_udp  # noqa: E402
+
+NUMBER = 20000
+HEADER = b"\x02\x12\x34\x00" + bytes.fromhex("aabbccfffe001122")
+
+
+def _rxpk(index: int) -> dict:
+    return {
+        "jver": 1,
+        "tmst": 1293718860 + index * 1000,
+        "time": "2026-10-18T10:00:00.123456Z",
+        "tmms": 1444730418123,
+        "chan": index % 8,
+        "rfch": index % 2,
+        "freq": 867.1 + 0.2 * (index % 8),
+        "mid": 8,
+        "stat": 1,
+        "modu": "LORA",
+        "datr": "SF7BW125",
+        "codr": "4/5",
+        "rssis": -97,
+        "lsnr": 7.5,
+        "foff": -1234,
+        "rssi": -96,
+        "size": 23,
+        "data": base64.b64encode(os.urandom(23)).decode(),
+    }
+
+
+def _synthetic_frames() -> list[tuple[str, bytes]]:
+    frames = []
+    for rxpk_count in (1, 2, 4, 8):
+        payload = {"rxpk": [_rxpk(i) for i in range(rxpk_count)]}
+        frame = HEADER + json.dumps(payload, separators=(",", ":")).encode()
+        frames.append((f"{rxpk_count} rxpk", frame))
+    return frames
+
+
+def _captured_frames(path: str) -> list[tuple[str, bytes]]:
+    frames = [
+        data
+        for _, direction, data in gwmp_capture.read_capture(path)
+        if direction == gwmp_capture.FROM_FORWARDER
+        and len(data) > 12
+        and data[3] == 0x00
+    ]
+    return [(f"{len(frames)} captured", frame) for frame in frames]
+
+
+def _old_path(data: bytes) -> int:
+    message_data = semtech_udp.process_message(data)
+    count = 0
+    for _rxpk in message_data["payload"].get("rxpk", []):
+        message_data["header"]["gateway_id"]
+        count += 1
+    return count
+
+
+def _new_path(data: bytes) -> int:
+    header = semtech_udp.parse_header_fast(data)
+    count = 0
+    for _rxpk in semtech_udp.iter_rxpk(data):
+        header.gateway_eui
+        count += 1
+    return count
+
+
+def _time(frames: list[bytes], parse) -> float:
+    def run():
+        for frame in frames:
+            parse(frame)
+
+    number = max(NUMBER // len(frames), 1)
+    return timeit.timeit(run, number=number) / (number * len(frames))
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        frames = _captured_frames(sys.argv[1])
+        if not frames:
+            sys.exit(f"no PUSH_DATA frames in {sys.argv[1]}")
+        groups = [(frames[0][0], [frame for _, frame in frames])]
+    else:
+        groups = [(label, [frame]) for label, frame in _synthetic_frames()]
+
+    print(f"{'frames':>12} {'old µs':>8} {'new µs':>8} {'speedup':>8}")
+    for label, frames in groups:
+        for frame in frames:
+            assert _old_path(frame) == _new_path(frame)
+        old = _time(frames, _old_path)
+        new = _time(frames, _new_path)
+        print(
+            f"{label:>12} {old * 1e6:>8.2f} {new * 1e6:>8.2f}"
+            f" {old / new:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,22 @@
 #!/usr/bin/python3
+import json
 import os
 import sqlite3
+import time
 from pathlib import Path
+import redis
 
 DB_FILE = os.path.join(os.getenv("DB_DIR", "."), "ttn_device_sessions.db")
 DECODERS_FOLDER = Path(os.getenv("DECODERS_DIR", "decoders"))
 
+# Published by request_ttn_devices.py after the sessions were refreshed
+SESSIONS_UPDATED_CHANNEL = "ttn_devices_updated"
+# Published by create_decoder_files with the [application_id, device_id]
+# pairs whose decoder file was rewritten
+DECODERS_UPDATED_CHANNEL = "ttn_decoders_updated"
+# Min. seconds between two mtime checks of DB_FILE
+SESSION_CHECK_INTERVAL = 10.0
+
 
 def get_latest_session_by_dev_addr(dev_addr, include_formatter=False):
     fields = """
@@ -51,7 +62,62 @@ def get_latest_sessions():
         return [dict(row) for row in rows]
 
 
+class SessionIndex:
+    """Latest session per DevAddr, held in memory.
+
+    get() is a dict lookup. The sessions are reloaded when the mtime of
+    DB_FILE has changed, checked at most every SESSION_CHECK_INTERVAL
+    seconds, or on the next lookup after invalidate().
+    """
+
+    _QUERY = """
+        SELECT dev_eui, application_id, device_id, started_at, dev_addr,
+            app_s_key, nwk_s_key
+        FROM device_sessions
+        ORDER BY started_at
+    """
+
+    def __init__(self, db_file=DB_FILE):
+        self._db_file = db_file
+        self._sessions = {}
+        self._mtime = None
+        self._next_check = 0.0
+
+    def invalidate(self):
+        self._mtime = None
+        self._next_check = 0.0
+
+    def _reload_if_changed(self):
+        self._next_check = time.monotonic() + SESSION_CHECK_INTERVAL
+        try:
+            mtime = os.stat(self._db_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        db_path = f"file:{self._db_file}?mode=ro"
+        with sqlite3.connect(db_path, uri=True) as conn:
+            conn.row_factory = sqlite3.Row
+            # later sessions replace earlier ones of the same DevAddr
+            sessions = {
+                row["dev_addr"]: dict(row) for row in conn.execute(self._QUERY)
+            }
+        self._sessions = sessions
+        self._mtime = mtime
+
+    def get(self, dev_addr):
+        if time.monotonic() >= self._next_check:
+            self._reload_if_changed()
+        return self._sessions.get(dev_addr)
+
+
+session_index = SessionIndex()
+
+
 def create_decoder_files():
+    """Writes the decoder files, returns the (application_id, device_id)
+    pairs whose file was created or changed."""
+    updated = []
     latest_sessions = get_latest_sessions()
     for _session in latest_sessions:
         application_id = _session["application_id"]
@@ -64,9 +130,26 @@ def create_decoder_files():
         file_path = app_folder / f"{device_id}.js"
         if "module.exports = { decodeUplink };" not in up_formatter:
             up_formatter += "\nmodule.exports = { decodeUplink };"
+        if file_path.exists() and file_path.read_text() == up_formatter:
+            continue
         with file_path.open("w") as file:
             file.write(up_formatter)
+        updated.append((application_id, device_id))
+    return updated
+
+
+def notify_decoders_updated(updated):
+    """Lets running message handlers drop cached results of these devices."""
+    try:
+        redis.Redis(
+            host=os.environ.get("REDIS_HOST", "127.0.0.1"),
+            port=int(os.environ.get("REDIS_PORT", 6379)),
+        ).publish(DECODERS_UPDATED_CHANNEL, json.dumps(updated))
+    except redis.RedisError as e:
+        print(f"Could not notify message handlers: {e}")
 
 
 if __name__ == "__main__":
-    create_decoder_files()
+    updated_decoders = create_decoder_files()
+    if updated_decoders:
+        notify_decoders_updated(updated_decoders)
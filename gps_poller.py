@@ -82,6 +82,7 @@ async def consume_gpsd():
                                 "lat": data["lat"],
                                 "lon": data["lon"],
                                 "alt": data.get("alt"),
+                                "utc": data["utc"],
                             }
                         ),
                     )
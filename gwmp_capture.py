@@ -0,0 +1,76 @@
+"""
+gwmp_capture.py – compact binary log of GWMP datagrams
+
+Written by gwmp_mux (MUX_CAPTURE_FILE) and read by gwmp_replay.py.
+
+File layout:
+  8 bytes   magic "GWMPCAP1"
+  records   timestamp (float64, time.monotonic), direction (uint8),
+            length (uint16), datagram (length bytes) – little endian
+"""
+
+import queue
+import struct
+import threading
+import time
+from collections.abc import Iterator
+
+MAGIC = b"GWMPCAP1"
+RECORD = struct.Struct("<dBH")
+
+FROM_FORWARDER = 0  # lora_pkt_fwd → mux
+FROM_UPSTREAM = 1  # network server → mux
+
+DIRECTION_NAMES = {FROM_FORWARDER: "forwarder", FROM_UPSTREAM: "upstream"}
+
+
+class CaptureWriter:
+    """Appends datagrams to a capture file from a background thread.
+
+    write() only timestamps and enqueues, so capturing adds no file I/O to
+    the forwarding path.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._write_loop, daemon=True, name="capture"
+        )
+        self._thread.start()
+
+    def write(self, direction: int, data: bytes) -> None:
+        self._queue.put((time.monotonic(), direction, data))
+
+    def _write_loop(self) -> None:
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            timestamp, direction, data = record
+            self._file.write(RECORD.pack(timestamp, direction, len(data)))
+            self._file.write(data)
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+def read_capture(path: str) -> Iterator[tuple[float, int, bytes]]:
+    """Yield (timestamp, direction, datagram) records of a capture file."""
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a GWMP capture file")
+        while True:
+            header = capture.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, length = RECORD.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, direction, data
@@ -3,17 +3,24 @@
 gwmp_mux.py – Semtech GWMP UDP multiplexer
 
 Sits between the sx1302_hal lora_pkt_fwd packet forwarder and the upstream
-LoRaWAN network server. Duplicates every PUSH_DATA frame (uplink) to a local
-consumer (e.g. message_collector) while maintaining the full upstream path
-including downlinks.
+LoRaWAN network server. Duplicates every PUSH_DATA frame (uplink) to one or
+more local consumers (e.g. message_collector) while maintaining the full
+upstream path including downlinks. Several upstream servers (e.g. TTN and a
+private ChirpStack) can be served at the same time.
 
-For mobile operation, GPS coordinates from gps_poller (via Redis key 'gps_latest')
-are injected into the PUSH_DATA stat frame before forwarding upstream. The local
-consumer always receives the original unmodified frame.
+Several packet forwarders (concentrators) may share one mux. Each gateway,
+identified by the EUI in its GWMP header, gets its own upstream socket per
+upstream server and its own pull address, so PULL_RESP downlinks arriving on
+a gateway's socket are relayed to that gateway's forwarder only.
+
+For mobile operation, GPS coordinates from gps_poller (via Redis channel 'gps')
+are injected into the PUSH_DATA stat frame before forwarding upstream. The last
+fix is kept in memory, so forwarding never waits for Redis. The local consumer
+always receives the original unmodified frame.
 
 Architecture:
 
-    gpsd → gps_poller → Redis 'gps_latest'
+    gpsd → gps_poller → Redis 'gps' channel
                                  │
     lora_pkt_fwd                 │
          │ UDP :1700 (localhost)  │
@@ -21,7 +28,8 @@ Architecture:
     │       gwmp_mux        │←───┘  injects GPS into stat frames
     └────┬──────────────────┘
          ├──→ eu1.cloud.thethings.network:1700  (GPS-enriched stat)
-         └──→ localhost:1701                    (original PUSH_DATA)
+         ├──→ further upstreams (optional)      (GPS policy per upstream)
+         └──→ localhost:1701 [, ...]            (original PUSH_DATA)
 
 GWMP packet types handled (protocol v2):
   0x00  PUSH_DATA   fwd → server   stat enriched with GPS; forwarded + copied
@@ -29,7 +37,8 @@ GWMP packet types handled (protocol v2):
   0x02  PULL_DATA   fwd → server   forwarded; ACK generated locally
   0x03  PULL_RESP   server → fwd   relayed to forwarder (downlinks)
   0x04  PULL_ACK    server → fwd   generated locally; upstream ACK discarded
-  0x05  TX_ACK      fwd → server   forwarded transparently
+  0x05  TX_ACK      fwd → server   forwarded to the upstream that sent the
+                                   matching PULL_RESP
 
 Configuration via environment variables:
   MUX_LISTEN_PORT       Port to bind (default: 1700)
@@ -37,21 +46,58 @@ Configuration via environment variables:
   MUX_UPSTREAM_PORT     Upstream server port (default: 1700)
   MUX_CONSUMER_HOST     Local consumer host (default: 127.0.0.1)
   MUX_CONSUMER_PORT     Local consumer port (default: 1701)
+  MUX_UPSTREAMS         Comma-separated upstream list "host:port[:gps|:raw]",
+                        overrides MUX_UPSTREAM_HOST/PORT. "gps" (default)
+                        injects the GPS fix into stat, "raw" forwards the
+                        original frame, e.g.
+                        "eu1.cloud.thethings.network:1700,10.0.0.5:1700:raw"
+  MUX_CONSUMERS         Comma-separated consumer list "host:port",
+                        overrides MUX_CONSUMER_HOST/PORT
+  MUX_DNS_TTL           Seconds between background re-resolutions of the
+                        upstream and consumer host names (default: 300,
+                        min. 5). Sends always use the cached address; the
+                        last good one is kept while a refresh fails. Names
+                        that never resolved are retried every 5 s.
+  MUX_GATEWAY_TTL       Seconds without traffic after which a gateway's pull
+                        address expires and its upstream sockets are closed
+                        (default: 120)
   MUX_LOG_LEVEL         Logging level (default: INFO)
+  MUX_ENGINE            "threads" – one blocking receive thread per socket –
+                        or "asyncio" – all sockets on one epoll event loop,
+                        without locks or thread switches (default: threads)
+  MUX_BATCH_IO          1 = drain all pending datagrams with one recvmmsg call
+                        and send the resulting copies per socket with one
+                        sendmmsg call (Linux only, default: 0)
+  MUX_BATCH_SIZE        Max. datagrams per recvmmsg call (default: 32)
+
+  MUX_METRICS_PORT      Port of the Prometheus text endpoint /metrics on
+                        127.0.0.1 (default: 0 = disabled)
+  MUX_CAPTURE_FILE      Write every received datagram with timestamp and
+                        direction to this file for gwmp_replay.py
+                        (default: unset = no capture)
 
   GPS_REDIS_HOST        Redis host (default: 127.0.0.1)
   GPS_REDIS_PORT        Redis port (default: 6379)
+  GPS_MAX_AGE           Seconds after which a fix is considered stale and no
+                        longer injected (default: 30, 0 = never stale)
 """
 
+import asyncio
+import bisect
 import json
 import logging
 import os
+import re
 import redis
 import signal
 import socket
 import sys
 import threading
-from threading import Lock
+import time
+import gwmp_capture
+import udp_mmsg
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # ---------------------------------------------------------------------------
 # Configuration
@@ -70,11 +116,62 @@ CONSUMER_ADDR = (
     int(os.environ.get("MUX_CONSUMER_PORT", 1701)),
 )
 
+
+def _parse_destinations(spec: str, options: tuple) -> list[tuple]:
+    """Parse "host:port[:option],..." into (host, port, option) tuples."""
+    destinations = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, rest = entry.partition(":")
+        port, _, option = rest.partition(":")
+        option = option or options[0]
+        if not host or not port.isdigit() or option not in options:
+            raise ValueError(f"invalid destination {entry!r}")
+        destinations.append((host, int(port), option))
+    return destinations
+
+
+UPSTREAMS = _parse_destinations(
+    os.environ.get("MUX_UPSTREAMS") or "%s:%d" % UPSTREAM_ADDR, ("gps", "raw")
+)
+CONSUMER_ADDRS = [
+    (host, port)
+    for host, port, _ in _parse_destinations(
+        os.environ.get("MUX_CONSUMERS") or "%s:%d" % CONSUMER_ADDR, ("",)
+    )
+]
+
 LOG_LEVEL = os.environ.get("MUX_LOG_LEVEL", "INFO").upper()
 
+# "threads" (one blocking thread per socket) or "asyncio" (single event loop)
+MUX_ENGINE = os.environ.get("MUX_ENGINE", "threads").lower()
+
+# Batched recvmmsg/sendmmsg I/O (Linux)
+MUX_BATCH_IO = os.environ.get("MUX_BATCH_IO", "0") == "1"
+MUX_BATCH_SIZE = int(os.environ.get("MUX_BATCH_SIZE", 32))
+
+# Upstream host name resolution
+MUX_DNS_TTL = float(os.environ.get("MUX_DNS_TTL", 300))
+# Retry interval for upstreams without an address, also the min. TTL
+DNS_RETRY_INTERVAL = 5.0
+
+# Per-gateway state expiry
+MUX_GATEWAY_TTL = float(os.environ.get("MUX_GATEWAY_TTL", 120))
+
+# Prometheus metrics endpoint
+MUX_METRICS_PORT = int(os.environ.get("MUX_METRICS_PORT", 0))
+
+# Traffic capture for gwmp_replay.py
+MUX_CAPTURE_FILE = os.environ.get("MUX_CAPTURE_FILE")
+
 # GPS via Redis
 GPS_REDIS_HOST = os.environ.get("GPS_REDIS_HOST", "127.0.0.1")
 GPS_REDIS_PORT = int(os.environ.get("GPS_REDIS_PORT", 6379))
+GPS_MAX_AGE = float(os.environ.get("GPS_MAX_AGE", 30))
+GPS_CHANNEL = "gps"
+GPS_RETRY_INTERVAL = 5.0
 
 # ---------------------------------------------------------------------------
 # GWMP constants
@@ -87,9 +184,24 @@ PULL_RESP = 0x03
 PULL_ACK = 0x04
 TX_ACK = 0x05
 
+PACKET_TYPE_NAMES = {
+    PUSH_DATA: "PUSH_DATA",
+    PUSH_ACK: "PUSH_ACK",
+    PULL_DATA: "PULL_DATA",
+    PULL_RESP: "PULL_RESP",
+    PULL_ACK: "PULL_ACK",
+    TX_ACK: "TX_ACK",
+}
+
 GWMP_HEADER_LEN = 4  # version(1) + token(2) + type(1)
+# Packets from the forwarder carry the gateway EUI right after the header.
+GWMP_EUI_END = GWMP_HEADER_LEN + 8
 RECV_BUF = 4096
 
+# Never block on a full socket buffer – a slow destination must not delay the
+# others, the datagram is dropped instead.
+SEND_FLAGS = getattr(socket, "MSG_DONTWAIT", 0)
+
 # ---------------------------------------------------------------------------
 
 logging.basicConfig(
@@ -104,30 +216,439 @@ def _build_ack(packet: bytes, ack_type: int) -> bytes:
     return bytes([packet[0], packet[1], packet[2], ack_type])
 
 
+# Top-level "stat" object of a PUSH_DATA payload. Each rxpk entry carries a
+# numeric "stat" (CRC status) as well, which this pattern does not match.
+_STAT_OBJECT = re.compile(rb'"stat"\s*:\s*\{')
+
+
+def _set_stat_position(stat: dict, pos: dict) -> None:
+    stat["lati"] = pos["lat"]
+    stat["long"] = pos["lon"]
+    if pos["alt"] is not None:
+        stat["alti"] = int(round(pos["alt"]))
+    else:
+        stat.pop("alti", None)
+    log.debug(
+        "stat GPS injected: lati=%.6f long=%.6f alti=%s",
+        pos["lat"],
+        pos["lon"],
+        stat.get("alti"),
+    )
+
+
 # ---------------------------------------------------------------------------
 # GPS provider
 # ---------------------------------------------------------------------------
 
 
 class GpsProvider:
-    """Reads the latest GPS position from the Redis key written by gps_poller."""
+    """Keeps the latest GPS fix in memory.
 
-    def __init__(self) -> None:
+    A background thread subscribes to the Redis channel published by
+    gps_poller and replaces the cached fix on every message. position() never
+    touches Redis, so a stalled or unavailable Redis cannot delay forwarding.
+    """
+
+    def __init__(self, max_age: float = GPS_MAX_AGE) -> None:
         self._client = redis.Redis(
             host=GPS_REDIS_HOST, port=GPS_REDIS_PORT, decode_responses=True
         )
+        self._max_age = max_age
+        # (monotonic receive time, position) – replaced as a whole, never
+        # mutated, so readers need no lock.
+        self._fix: tuple[float, dict] | None = None
+        self._running = False
 
-    def position(self) -> dict | None:
-        """Return latest valid position or None if no fix available."""
-        raw = self._client.get("gps_latest")
-        if raw is None:
-            return None
+    def start(self) -> None:
+        self._running = True
+        threading.Thread(
+            target=self._subscribe, daemon=True, name="gps-sub"
+        ).start()
+
+    def stop(self) -> None:
+        self._running = False
+
+    def _update(self, raw: str, seed: bool = False) -> None:
         pos = json.loads(raw)
         if pos.get("lat") is None or pos.get("lon") is None:
+            return
+        if seed:
+            # The stored fix may be hours old (gps_poller stopped or lost
+            # the fix). Its utc is only used to reject such a seed; live
+            # fixes are aged by their receive time, so injection does not
+            # depend on the system clock agreeing with GPS time.
+            utc = pos.get("utc")
+            if utc is None:
+                return
+            if self._max_age > 0 and time.time() - utc > self._max_age:
+                return
+        self._fix = (
+            time.monotonic(),
+            {"lat": pos["lat"], "lon": pos["lon"], "alt": pos.get("alt")},
+        )
+
+    def _subscribe(self) -> None:
+        while self._running:
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(GPS_CHANNEL)
+                # Seed from the last stored fix once subscribed, so there is
+                # a position before the next gps_poller update arrives.
+                if self._fix is None:
+                    raw = self._client.get("gps_latest")
+                    if raw is not None:
+                        self._update(raw, seed=True)
+                while self._running:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._update(message["data"])
+            except (redis.RedisError, ValueError) as exc:
+                log.warning("GPS subscription failed: %s", exc)
+                time.sleep(GPS_RETRY_INTERVAL)
+            finally:
+                pubsub.close()
+
+    def position(self) -> dict | None:
+        """Return latest valid position or None if no fresh fix available."""
+        fix = self._fix
+        if fix is None:
+            return None
+        received, pos = fix
+        if self._max_age > 0 and time.monotonic() - received > self._max_age:
             return None
         return pos
 
 
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+
+class _MetricsShard:
+    def __init__(self, bucket_count: int) -> None:
+        self.counters: dict[tuple, int] = {}
+        self.latency_buckets = [0] * bucket_count
+        self.latency_sum = 0.0
+
+
+class Metrics:
+    """Counters and a latency histogram, rendered in Prometheus text format.
+
+    Every thread updates a shard of its own, so the hot path takes no lock;
+    render() sums the shards (each copy is a single C call under the GIL).
+    """
+
+    LATENCY_BUCKETS = (
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+    )
+    HELP = {
+        "gwmp_packets_received_total": "GWMP packets received by type",
+        "gwmp_datagrams_sent_total": "Datagrams sent by destination",
+        "gwmp_send_errors_total": "Failed sends by destination",
+        "gwmp_gps_injections_total": "PUSH_DATA stat GPS injection attempts",
+        "gwmp_upstream_latency_seconds": "PUSH_DATA receive to upstream send",
+    }
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._shards: list[_MetricsShard] = []
+        self._gauges: dict[str, tuple] = {}
+
+    def _shard(self) -> _MetricsShard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = _MetricsShard(len(self.LATENCY_BUCKETS) + 1)
+            self._local.shard = shard
+            self._shards.append(shard)
+            return shard
+
+    def inc(self, name: str, labels: tuple = (), amount: int = 1) -> None:
+        """Increment a counter; labels are (name, value) pairs."""
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe_latency(self, seconds: float) -> None:
+        shard = self._shard()
+        shard.latency_buckets[
+            bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        ] += 1
+        shard.latency_sum += seconds
+
+    def gauge(self, name: str, help_text: str, collect) -> None:
+        """Register a gauge; collect() returns [(labels, value), ...]."""
+        self._gauges[name] = (help_text, collect)
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        return "{%s}" % ",".join(f'{key}="{value}"' for key, value in labels)
+
+    def render(self) -> str:
+        counters: dict[tuple, int] = {}
+        buckets = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        latency_sum = 0.0
+        for shard in list(self._shards):
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for index, value in enumerate(list(shard.latency_buckets)):
+                buckets[index] += value
+            latency_sum += shard.latency_sum
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for (key, labels), value in sorted(counters.items()):
+                if key == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+
+        name = "gwmp_upstream_latency_seconds"
+        lines.append(f"# HELP {name} {self.HELP[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, value in zip(self.LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += value
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum {latency_sum}")
+        lines.append(f"{name}_count {cumulative}")
+
+        for name, (help_text, collect) in self._gauges.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in collect():
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int) -> None:
+        """Serve render() at http://127.0.0.1:<port>/metrics in a thread."""
+        metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        threading.Thread(
+            target=server.serve_forever, daemon=True, name="metrics"
+        ).start()
+
+
+metrics = Metrics()
+
+# Label tuples built once, not per packet.
+_RECEIVED_LABELS = {
+    (source, pkt_type): (("source", source), ("type", name))
+    for source in ("forwarder", "upstream")
+    for pkt_type, name in PACKET_TYPE_NAMES.items()
+}
+_DEST_LABELS = {
+    dest: (("dest", dest),) for dest in ("forwarder", "upstream", "consumer")
+}
+
+
+def _count_received(source: str, pkt_type: int) -> None:
+    labels = _RECEIVED_LABELS.get((source, pkt_type))
+    if labels is None:
+        labels = (("source", source), ("type", "0x%02x" % pkt_type))
+    metrics.inc("gwmp_packets_received_total", labels)
+
+
+# ---------------------------------------------------------------------------
+# Forwarding
+# ---------------------------------------------------------------------------
+
+
+class Upstream:
+    """A network server the forwarder traffic is relayed to.
+
+    Also used for the local consumers (kind "consumer"), so their host
+    names are resolved and refreshed the same way.
+    """
+
+    def __init__(
+        self, host: str, port: int, inject_gps: bool, kind: str = "upstream"
+    ) -> None:
+        self.name = "%s:%d" % (host, port)
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.inject_gps = inject_gps
+        # Resolved (ip, port). Sends never resolve; resolve() refreshes it
+        # in the background and keeps the last good address on failure.
+        self.addr: tuple | None = None
+        self.resolve_seconds = 0.0
+        self.resolve_failures = 0
+
+    def resolve(self) -> None:
+        started = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(
+                self.host, self.port, socket.AF_INET, socket.SOCK_DGRAM
+            )
+        except OSError as exc:
+            self.resolve_failures += 1
+            log.warning(
+                "resolving %s %s failed, keeping %s: %s",
+                self.kind,
+                self.name,
+                self.addr,
+                exc,
+            )
+            return
+        finally:
+            self.resolve_seconds = time.monotonic() - started
+        addr = infos[0][4]
+        if addr != self.addr:
+            log.info(
+                "%s %s resolved to %s:%d (%.3f s)",
+                self.kind,
+                self.name,
+                *addr,
+                self.resolve_seconds,
+            )
+        else:
+            log.debug(
+                "%s %s still at %s:%d (%.3f s)",
+                self.kind,
+                self.name,
+                *addr,
+                self.resolve_seconds,
+            )
+        self.addr = addr
+
+    def __str__(self) -> str:
+        policy = "GPS-enriched" if self.inject_gps else "raw"
+        return "%s (%s)" % (self.name, policy)
+
+
+class DirectSender:
+    """Sends every datagram immediately with sendto.
+
+    `kind` is "forwarder", "upstream" or "consumer"; `received` is the
+    monotonic receive time of a PUSH_DATA, for the latency histogram.
+    """
+
+    @staticmethod
+    def send(
+        sock: socket.socket,
+        data: bytes,
+        dest: tuple,
+        kind: str,
+        received: float | None = None,
+    ) -> None:
+        try:
+            sock.sendto(data, SEND_FLAGS, dest)
+        except OSError as exc:
+            metrics.inc("gwmp_send_errors_total", _DEST_LABELS[kind])
+            log.warning("%s send to %s failed: %s", kind, dest, exc)
+            return
+        metrics.inc("gwmp_datagrams_sent_total", _DEST_LABELS[kind])
+        if received is not None:
+            metrics.observe_latency(time.monotonic() - received)
+
+    def flush(self) -> None:
+        pass
+
+
+class BatchSender:
+    """Collects datagrams per socket and sends them on flush() via sendmmsg.
+
+    Each receive loop owns its own instance, so no locking is needed.
+    """
+
+    def __init__(self) -> None:
+        self._pending: dict[socket.socket, list[tuple]] = {}
+
+    def send(
+        self,
+        sock: socket.socket,
+        data: bytes,
+        dest: tuple,
+        kind: str,
+        received: float | None = None,
+    ) -> None:
+        pending = self._pending.get(sock)
+        if pending is None:
+            pending = self._pending[sock] = []
+        pending.append((data, dest, kind, received))
+
+    def flush(self) -> None:
+        for sock, pending in self._pending.items():
+            failures = udp_mmsg.sendmmsg(
+                sock, [(entry[0], entry[1]) for entry in pending], SEND_FLAGS
+            )
+            failed = set()
+            for index, exc in failures:
+                _, dest, kind, _ = pending[index]
+                failed.add(index)
+                metrics.inc("gwmp_send_errors_total", _DEST_LABELS[kind])
+                log.warning("%s send to %s failed: %s", kind, dest, exc)
+            now = time.monotonic()
+            for index, (_, _, kind, received) in enumerate(pending):
+                if index in failed:
+                    continue
+                metrics.inc("gwmp_datagrams_sent_total", _DEST_LABELS[kind])
+                if received is not None:
+                    metrics.observe_latency(now - received)
+        self._pending.clear()
+
+
+_DIRECT = DirectSender()
+
+
+class Gateway:
+    """State of one packet forwarder, keyed by its gateway EUI."""
+
+    def __init__(self, eui: bytes, upstream_count: int) -> None:
+        self.eui = eui
+        self.last_seen = time.monotonic()
+        # (address, monotonic time of the last PULL_DATA) – replaced as a
+        # whole by the forwarder side, read by the upstream side without lock.
+        self.pull: tuple[tuple, float] | None = None
+        # One socket per upstream: the network server sees one UDP flow per
+        # gateway and sends the gateway's PULL_RESP back on that socket.
+        self.socks = [
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for _ in range(upstream_count)
+        ]
+        # TX_ACK token → index of the upstream that sent the PULL_RESP.
+        self.downlink_tokens: dict[bytes, int] = {}
+
+    def pull_addr(self, now: float) -> tuple | None:
+        pull = self.pull
+        if pull is None or now - pull[1] > MUX_GATEWAY_TTL:
+            return None
+        return pull[0]
+
+    def __str__(self) -> str:
+        return self.eui.hex()
+
+
 class GWMPMultiplexer:
     # PUSH_DATA layout: version(1) + token(2) + type(1) + gateway_EUI(8) = 12 bytes before JSON
     PUSH_DATA_HDR_LEN = 12
@@ -138,13 +659,32 @@ class GWMPMultiplexer:
         self._listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._listen_sock.bind(LISTEN_ADDR)
 
-        self._upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._upstreams = [
+            Upstream(host, port, option == "gps")
+            for host, port, option in UPSTREAMS
+        ]
         self._consumer_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._consumers = [
+            Upstream(host, port, False, "consumer")
+            for host, port in CONSUMER_ADDRS
+        ]
+
+        # Gateway EUI → Gateway. Only modified while handling forwarder
+        # packets; the upstream side holds direct references to its Gateway.
+        self._gateways: dict[bytes, Gateway] = {}
+        self._next_expiry = time.monotonic() + MUX_GATEWAY_TTL
+
+        # Engine hooks to start/stop receiving on a gateway's upstream socket.
+        self._watch = None
+        self._unwatch = None
+
+        self._capture = None
+        if MUX_CAPTURE_FILE:
+            self._capture = gwmp_capture.CaptureWriter(MUX_CAPTURE_FILE)
 
-        # Pull socket source address – needed to relay PULL_RESP (downlinks) back.
-        # Written by the forwarder thread, read by the upstream thread.
-        self._pull_addr: tuple | None = None
-        self._pull_addr_lock = Lock()
+        self._batch_io = MUX_BATCH_IO and udp_mmsg.AVAILABLE
+        if MUX_BATCH_IO and not self._batch_io:
+            log.warning("recvmmsg/sendmmsg unavailable, batched I/O disabled")
 
         self._running = False
 
@@ -152,117 +692,303 @@ class GWMPMultiplexer:
     # Helpers
     # ------------------------------------------------------------------
 
-    def _ack(self, dest: tuple, packet: bytes, ack_type: int) -> None:
-        try:
-            self._listen_sock.sendto(_build_ack(packet, ack_type), dest)
-        except OSError as exc:
-            log.warning("ACK to %s failed: %s", dest, exc)
+    def _ack(self, out, dest: tuple, packet: bytes, ack_type: int) -> None:
+        out.send(
+            self._listen_sock, _build_ack(packet, ack_type), dest, "forwarder"
+        )
 
-    def _forward_upstream(self, data: bytes) -> None:
-        try:
-            self._upstream_sock.sendto(data, UPSTREAM_ADDR)
-        except OSError as exc:
-            log.warning("upstream send failed: %s", exc)
+    @staticmethod
+    def _send_upstream(
+        out,
+        sock: socket.socket,
+        upstream: Upstream,
+        data: bytes,
+        received: float | None = None,
+    ) -> None:
+        addr = upstream.addr
+        if addr is None:
+            metrics.inc("gwmp_send_errors_total", _DEST_LABELS["upstream"])
+            log.warning("upstream %s unresolved, datagram dropped", upstream)
+            return
+        out.send(sock, data, addr, "upstream", received)
 
-    def _forward_consumer(self, data: bytes) -> None:
-        try:
-            self._consumer_sock.sendto(data, CONSUMER_ADDR)
-        except OSError as exc:
-            log.warning("consumer send failed: %s", exc)
+    def _forward_upstream(self, out, gateway: Gateway, data: bytes) -> None:
+        for upstream, sock in zip(self._upstreams, gateway.socks):
+            self._send_upstream(out, sock, upstream, data)
+
+    def _forward_push_data(
+        self, out, gateway: Gateway, data: bytes, received: float
+    ) -> None:
+        injected = None
+        for upstream, sock in zip(self._upstreams, gateway.socks):
+            if upstream.inject_gps:
+                if injected is None:
+                    injected = self._inject_gps(data)
+                self._send_upstream(out, sock, upstream, injected, received)
+            else:
+                self._send_upstream(out, sock, upstream, data, received)
+
+    def _forward_consumer(self, out, data: bytes) -> None:
+        for consumer in self._consumers:
+            if consumer.addr is None:
+                metrics.inc("gwmp_send_errors_total", _DEST_LABELS["consumer"])
+                continue
+            out.send(self._consumer_sock, data, consumer.addr, "consumer")
 
     def _inject_gps(self, data: bytes) -> bytes:
-        """Overwrite lati/long/alti in the stat frame with the current GPS fix."""
+        """Overwrite lati/long/alti in the stat frame with the current GPS fix.
+
+        Only the stat object is parsed and re-serialized; the bytes around it
+        (header, rxpk array) are reused as they are. Frames without a stat
+        object are returned unchanged without any JSON parsing.
+        """
         pos = self._gps.position()
         if pos is None:
+            metrics.inc("gwmp_gps_injections_total", (("result", "miss"),))
+            return data
+        match = _STAT_OBJECT.search(data, self.PUSH_DATA_HDR_LEN)
+        if match is None:
             return data
+        start = match.end() - 1
+        end = data.find(b"}", start) + 1
+        # stat is a flat object – anything nested means an unexpected layout.
+        if end == 0 or data.find(b"{", start + 1, end) != -1:
+            return self._inject_gps_json(data, pos)
+        try:
+            stat = json.loads(data[start:end])
+        except ValueError:
+            return self._inject_gps_json(data, pos)
+        _set_stat_position(stat, pos)
+        metrics.inc("gwmp_gps_injections_total", (("result", "hit"),))
+        return (
+            data[:start]
+            + json.dumps(stat, separators=(",", ":")).encode()
+            + data[end:]
+        )
+
+    def _inject_gps_json(self, data: bytes, pos: dict) -> bytes:
+        """Fallback for _inject_gps: full JSON round-trip of the payload."""
         header = data[: self.PUSH_DATA_HDR_LEN]
         payload = json.loads(data[self.PUSH_DATA_HDR_LEN :])
         if "stat" not in payload:
             return data
-        payload["stat"]["lati"] = pos["lat"]
-        payload["stat"]["long"] = pos["lon"]
-        if pos["alt"] is not None:
-            payload["stat"]["alti"] = int(round(pos["alt"]))
-        else:
-            payload["stat"].pop("alti", None)
-        log.debug(
-            "stat GPS injected: lati=%.6f long=%.6f alti=%s",
-            pos["lat"],
-            pos["lon"],
-            payload["stat"].get("alti"),
-        )
+        _set_stat_position(payload["stat"], pos)
+        metrics.inc("gwmp_gps_injections_total", (("result", "hit"),))
         return header + json.dumps(payload, separators=(",", ":")).encode()
 
     # ------------------------------------------------------------------
-    # Thread: packets from lora_pkt_fwd
+    # Packet handlers – shared by both engines. `out` is the DirectSender
+    # or BatchSender of the receive loop that called the handler.
     # ------------------------------------------------------------------
 
-    def _from_forwarder(self) -> None:
-        while self._running:
-            try:
-                data, addr = self._listen_sock.recvfrom(RECV_BUF)
-            except OSError:
-                break
-            if len(data) < GWMP_HEADER_LEN:
-                continue
+    def _gateway(self, eui: bytes, now: float) -> Gateway:
+        gateway = self._gateways.get(eui)
+        if gateway is None:
+            gateway = self._gateways[eui] = Gateway(eui, len(self._upstreams))
+            for index, sock in enumerate(gateway.socks):
+                self._watch(
+                    sock,
+                    partial(self._handle_upstream, gateway, index),
+                    f"from-upstream-{gateway}-{index}",
+                )
+            log.info("gateway %s connected", gateway)
+        gateway.last_seen = now
+        # checked on any forwarder packet, so gateways that went away
+        # expire even when no new one connects
+        if now >= self._next_expiry:
+            self._expire_gateways(now)
+        return gateway
+
+    def _expire_gateways(self, now: float) -> None:
+        self._next_expiry = now + MUX_GATEWAY_TTL
+        for eui, gateway in list(self._gateways.items()):
+            if now - gateway.last_seen > MUX_GATEWAY_TTL:
+                del self._gateways[eui]
+                for sock in gateway.socks:
+                    self._unwatch(sock)
+                log.info("gateway %s expired", gateway)
 
-            pkt_type = data[3]
+    def _handle_forwarder(self, data: bytes, addr: tuple, out) -> None:
+        if self._capture is not None:
+            self._capture.write(gwmp_capture.FROM_FORWARDER, data)
+        if len(data) < GWMP_EUI_END:
+            return
 
-            if pkt_type == PUSH_DATA:
-                self._ack(addr, data, PUSH_ACK)
-                self._forward_upstream(self._inject_gps(data))
-                self._forward_consumer(data)  # original, without GPS injection
+        pkt_type = data[3]
+        now = time.monotonic()
+        _count_received("forwarder", pkt_type)
 
-            elif pkt_type == PULL_DATA:
-                with self._pull_addr_lock:
-                    self._pull_addr = addr
-                self._ack(addr, data, PULL_ACK)
-                self._forward_upstream(data)  # keepalive
+        if pkt_type == PUSH_DATA:
+            gateway = self._gateway(data[GWMP_HEADER_LEN:GWMP_EUI_END], now)
+            self._ack(out, addr, data, PUSH_ACK)
+            self._forward_push_data(out, gateway, data, now)
+            self._forward_consumer(out, data)  # original, no GPS injection
 
-            elif pkt_type == TX_ACK:
-                self._forward_upstream(data)
+        elif pkt_type == PULL_DATA:
+            gateway = self._gateway(data[GWMP_HEADER_LEN:GWMP_EUI_END], now)
+            gateway.pull = (addr, now)
+            self._ack(out, addr, data, PULL_ACK)
+            self._forward_upstream(out, gateway, data)  # keepalive
 
+        elif pkt_type == TX_ACK:
+            gateway = self._gateway(data[GWMP_HEADER_LEN:GWMP_EUI_END], now)
+            index = gateway.downlink_tokens.pop(data[1:3], None)
+            if index is None:
+                self._forward_upstream(out, gateway, data)
+            else:
+                self._send_upstream(
+                    out, gateway.socks[index], self._upstreams[index], data
+                )
+
+        else:
+            log.warning(
+                "unexpected type 0x%02x from forwarder %s", pkt_type, addr
+            )
+
+    def _handle_upstream(
+        self, gateway: Gateway, index: int, data: bytes, addr: tuple, out
+    ) -> None:
+        if self._capture is not None:
+            self._capture.write(gwmp_capture.FROM_UPSTREAM, data)
+        if len(data) < GWMP_HEADER_LEN:
+            return
+
+        pkt_type = data[3]
+        _count_received("upstream", pkt_type)
+
+        if pkt_type in (PUSH_ACK, PULL_ACK):
+            # ACK'd locally already – discard upstream duplicate
+            pass
+
+        elif pkt_type == PULL_RESP:
+            pull_addr = gateway.pull_addr(time.monotonic())
+            if pull_addr:
+                gateway.downlink_tokens[data[1:3]] = index
+                out.send(self._listen_sock, data, pull_addr, "forwarder")
             else:
                 log.warning(
-                    "unexpected type 0x%02x from forwarder %s", pkt_type, addr
+                    "PULL_RESP received but pull address of gateway %s "
+                    "unknown or expired",
+                    gateway,
                 )
 
+        else:
+            log.warning(
+                "unexpected type 0x%02x from upstream %s", pkt_type, addr
+            )
+
     # ------------------------------------------------------------------
-    # Thread: packets from upstream network server
+    # Engine "threads": one blocking receive thread per socket
     # ------------------------------------------------------------------
 
-    def _from_upstream(self) -> None:
+    def _receive_loop(self, sock: socket.socket, handler) -> None:
+        if self._batch_io:
+            return self._receive_batch_loop(sock, handler)
         while self._running:
             try:
-                data, addr = self._upstream_sock.recvfrom(RECV_BUF)
+                data, addr = sock.recvfrom(RECV_BUF)
             except OSError:
                 break
-            if len(data) < GWMP_HEADER_LEN:
+            handler(data, addr, _DIRECT)
+
+    def _receive_batch_loop(self, sock: socket.socket, handler) -> None:
+        receiver = udp_mmsg.MessageReceiver(sock, MUX_BATCH_SIZE, RECV_BUF)
+        out = BatchSender()
+        while self._running:
+            try:
+                # Blocks for the first datagram, then takes all pending ones.
+                packets = receiver.recv(udp_mmsg.MSG_WAITFORONE)
+            except InterruptedError:
                 continue
+            except OSError:
+                break
+            for data, addr in packets:
+                handler(data, addr, out)
+            out.flush()
 
-            pkt_type = data[3]
+    def _start_thread(self, sock: socket.socket, handler, name: str):
+        thread = threading.Thread(
+            target=self._receive_loop,
+            args=(sock, handler),
+            daemon=True,
+            name=name,
+        )
+        thread.start()
+        return thread
 
-            if pkt_type in (PUSH_ACK, PULL_ACK):
-                # ACK'd locally already – discard upstream duplicate
-                pass
+    @staticmethod
+    def _close_socket(sock: socket.socket) -> None:
+        try:
+            # Wakes up a thread blocked in recvfrom on this socket.
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
 
-            elif pkt_type == PULL_RESP:
-                with self._pull_addr_lock:
-                    pull_addr = self._pull_addr
-                if pull_addr:
-                    try:
-                        self._listen_sock.sendto(data, pull_addr)
-                    except OSError as exc:
-                        log.warning("PULL_RESP relay failed: %s", exc)
-                else:
-                    log.warning(
-                        "PULL_RESP received but forwarder pull address unknown"
-                    )
+    def _run_threads(self) -> None:
+        self._watch = self._start_thread
+        self._unwatch = self._close_socket
+        self._start_thread(
+            self._listen_sock, self._handle_forwarder, "from-fwd"
+        ).join()
 
-            else:
-                log.warning(
-                    "unexpected type 0x%02x from upstream %s", pkt_type, addr
-                )
+    # ------------------------------------------------------------------
+    # Engine "asyncio": all sockets served by a single event loop
+    # ------------------------------------------------------------------
+
+    def _drain(self, sock: socket.socket, handler) -> None:
+        """Handle every datagram pending on a non-blocking socket."""
+        while self._running:
+            try:
+                data, addr = sock.recvfrom(RECV_BUF)
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                log.warning("receive failed: %s", exc)
+                return
+            handler(data, addr, _DIRECT)
+
+    def _drain_batch(self, receiver, handler, out: BatchSender) -> None:
+        """Like _drain, but recvmmsg/sendmmsg based."""
+        while self._running:
+            try:
+                packets = receiver.recv(socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                log.warning("receive failed: %s", exc)
+                return
+            for data, addr in packets:
+                handler(data, addr, out)
+            out.flush()
+
+    def _add_reader(self, sock: socket.socket, handler, _name: str) -> None:
+        sock.setblocking(False)
+        if self._batch_io:
+            receiver = udp_mmsg.MessageReceiver(sock, MUX_BATCH_SIZE, RECV_BUF)
+            self._loop.add_reader(
+                sock.fileno(),
+                self._drain_batch,
+                receiver,
+                handler,
+                BatchSender(),
+            )
+        else:
+            self._loop.add_reader(sock.fileno(), self._drain, sock, handler)
+
+    def _remove_reader(self, sock: socket.socket) -> None:
+        self._loop.remove_reader(sock.fileno())
+        sock.close()
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._watch = self._add_reader
+        self._unwatch = self._remove_reader
+        self._add_reader(self._listen_sock, self._handle_forwarder, "from-fwd")
+        await self._loop.create_future()  # runs until stop()/signal
+
+    def _run_asyncio(self) -> None:
+        asyncio.run(self._serve())
 
     # ------------------------------------------------------------------
     # Lifecycle
@@ -270,31 +996,111 @@ class GWMPMultiplexer:
 
     def run(self) -> None:
         self._running = True
-        log.info("gwmp-mux started")
+        log.info(
+            "gwmp-mux started (engine: %s, batch I/O: %s)",
+            MUX_ENGINE,
+            "on" if self._batch_io else "off",
+        )
         log.info("  listen   : %s:%d", *LISTEN_ADDR)
-        log.info("  upstream : %s:%d", *UPSTREAM_ADDR)
-        log.info("  consumer : %s:%d", *CONSUMER_ADDR)
+        for upstream in self._upstreams:
+            log.info("  upstream : %s", upstream)
+        if self._capture is not None:
+            log.info("  capture  : %s", MUX_CAPTURE_FILE)
+        for consumer in self._consumers:
+            log.info("  consumer : %s", consumer.name)
         log.info(
-            "  GPS      : redis %s:%d key 'gps_latest'",
+            "  GPS      : redis %s:%d channel '%s' (max age %gs)",
             GPS_REDIS_HOST,
             GPS_REDIS_PORT,
+            GPS_CHANNEL,
+            GPS_MAX_AGE,
         )
 
-        t1 = threading.Thread(
-            target=self._from_forwarder, daemon=True, name="from-fwd"
-        )
-        t2 = threading.Thread(
-            target=self._from_upstream, daemon=True, name="from-upstream"
-        )
-        t1.start()
-        t2.start()
-        t1.join()
-        t2.join()
+        for destination in self._upstreams + self._consumers:
+            destination.resolve()
+        threading.Thread(
+            target=self._refresh_upstreams, daemon=True, name="dns"
+        ).start()
+
+        if MUX_METRICS_PORT:
+            metrics.gauge(
+                "gwmp_gateways",
+                "Gateways with live state",
+                lambda: [((), len(self._gateways))],
+            )
+            metrics.gauge(
+                "gwmp_upstream_address",
+                "Resolved upstream address (value is always 1)",
+                lambda: [
+                    (
+                        (
+                            ("upstream", upstream.name),
+                            ("address", "%s:%d" % upstream.addr),
+                        ),
+                        1,
+                    )
+                    for upstream in self._upstreams
+                    if upstream.addr is not None
+                ],
+            )
+            metrics.gauge(
+                "gwmp_upstream_resolve_seconds",
+                "Duration of the last upstream name resolution",
+                lambda: [
+                    ((("upstream", upstream.name),), upstream.resolve_seconds)
+                    for upstream in self._upstreams
+                ],
+            )
+            metrics.gauge(
+                "gwmp_upstream_resolve_failures",
+                "Failed upstream name resolutions since start",
+                lambda: [
+                    ((("upstream", upstream.name),), upstream.resolve_failures)
+                    for upstream in self._upstreams
+                ],
+            )
+            metrics.serve(MUX_METRICS_PORT)
+            log.info(
+                "  metrics  : http://127.0.0.1:%d/metrics", MUX_METRICS_PORT
+            )
+
+        if MUX_ENGINE == "asyncio":
+            self._run_asyncio()
+        else:
+            self._run_threads()
+
+    def _refresh_upstreams(self) -> None:
+        """Re-resolves the upstream and consumer host names."""
+        destinations = self._upstreams + self._consumers
+        ttl = max(MUX_DNS_TTL, DNS_RETRY_INTERVAL)
+        next_refresh = time.monotonic() + ttl
+        while self._running:
+            delay = next_refresh - time.monotonic()
+            if any(destination.addr is None for destination in destinations):
+                # not resolved yet (e.g. network not up at start): retry soon
+                delay = min(delay, DNS_RETRY_INTERVAL)
+            time.sleep(max(delay, 0.0))
+            if time.monotonic() >= next_refresh:
+                next_refresh = time.monotonic() + ttl
+                due = destinations
+            else:
+                due = [
+                    destination
+                    for destination in destinations
+                    if destination.addr is None
+                ]
+            for destination in due:
+                destination.resolve()
 
     def stop(self) -> None:
         log.info("gwmp-mux stopping")
         self._running = False
-        for s in (self._listen_sock, self._upstream_sock, self._consumer_sock):
+        if self._capture is not None:
+            self._capture.close()
+        sockets = [self._listen_sock, self._consumer_sock]
+        for gateway in list(self._gateways.values()):
+            sockets += gateway.socks
+        for s in sockets:
             try:
                 s.close()
             except OSError:
@@ -309,12 +1115,14 @@ def main() -> None:
     mux = GWMPMultiplexer(gps)
 
     def _handle_signal(sig, _frame):
+        gps.stop()
         mux.stop()
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, _handle_signal)
     signal.signal(signal.SIGINT, _handle_signal)
 
+    gps.start()
     mux.run()
 
 
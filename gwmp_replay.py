@@ -0,0 +1,324 @@
+#!venv/bin/python3
+"""
+gwmp_replay.py – GWMP load generator for gwmp_mux and message_collector
+
+Two modes, both acting as one or more lora_pkt_fwd instances (one UDP socket
+per gateway EUI):
+
+  replay    Plays the forwarder → mux datagrams of a capture file written by
+            gwmp_mux (MUX_CAPTURE_FILE) at the recorded pace, N times faster
+            or as fast as possible.
+  emulate   Generates synthetic traffic: PULL_DATA keepalives, stat frames and
+            uplink PUSH_DATA frames with a configurable rxpk count and rate.
+
+Reports the achieved datagram rate and, when the target acknowledges
+(gwmp_mux), PUSH_ACK/PULL_ACK round-trip latency percentiles.
+message_collector sends no ACKs; only the send rate is reported then.
+
+Examples:
+  venv/bin/python3 gwmp_replay.py replay capture.bin --speed 10
+  venv/bin/python3 gwmp_replay.py emulate --gateways 3 --rate 200 --rxpk 4
+  venv/bin/python3 gwmp_replay.py emulate --target 127.0.0.1:1701 --rate 0
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import selectors
+import socket
+import struct
+import time
+
+import gwmp_capture
+
+PUSH_DATA = 0x00
+PUSH_ACK = 0x01
+PULL_DATA = 0x02
+PULL_ACK = 0x04
+
+EXPECTED_ACK = {PUSH_DATA: PUSH_ACK, PULL_DATA: PULL_ACK}
+
+KEEPALIVE_INTERVAL = 10.0  # lora_pkt_fwd default keepalive_interval
+STAT_INTERVAL = 30.0  # lora_pkt_fwd default stat_interval
+DRAIN_TIMEOUT = 1.0  # wait for late ACKs after the last datagram
+
+
+def _parse_target(value: str) -> tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host, int(port)
+
+
+class LoadGenerator:
+    """Sends GWMP datagrams from one socket per gateway and matches ACKs."""
+
+    def __init__(self, target: tuple[str, int]) -> None:
+        self._target = target
+        self._selector = selectors.DefaultSelector()
+        self._sockets: dict[bytes, socket.socket] = {}
+        # (gateway EUI, token, expected ACK type) → send time
+        self._pending: dict[tuple, float] = {}
+        self.sent = 0
+        self.send_errors = 0
+        self.latencies: list[float] = []
+
+    def _socket(self, eui: bytes) -> socket.socket:
+        sock = self._sockets.get(eui)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._selector.register(sock, selectors.EVENT_READ, eui)
+            self._sockets[eui] = sock
+        return sock
+
+    def send(self, data: bytes) -> None:
+        if len(data) < 12:
+            return
+        eui = data[4:12]
+        try:
+            self._socket(eui).sendto(data, self._target)
+        except OSError:
+            self.send_errors += 1
+            return
+        self.sent += 1
+        ack_type = EXPECTED_ACK.get(data[3])
+        if ack_type is not None:
+            self._pending[(eui, data[1:3], ack_type)] = time.monotonic()
+
+    def poll(self, timeout: float) -> None:
+        """Receive ACKs until timeout (seconds) has passed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            for key, _ in self._selector.select(max(remaining, 0)):
+                self._receive(key.fileobj, key.data)
+            if remaining <= 0:
+                return
+
+    def _receive(self, sock: socket.socket, eui: bytes) -> None:
+        while True:
+            try:
+                data = sock.recv(4096)
+            except BlockingIOError:
+                return
+            except OSError:
+                # e.g. ECONNREFUSED from an earlier send – nothing listens
+                return
+            if len(data) < 4:
+                continue
+            sent_at = self._pending.pop((eui, data[1:3], data[3]), None)
+            if sent_at is not None:
+                self.latencies.append(time.monotonic() - sent_at)
+
+    def report(self, elapsed: float) -> None:
+        rate = self.sent / elapsed if elapsed > 0 else 0.0
+        print(f"gateways      : {len(self._sockets)}")
+        print(f"sent          : {self.sent} datagrams in {elapsed:.2f} s")
+        print(f"rate          : {rate:.1f} datagrams/s")
+        print(f"send errors   : {self.send_errors}")
+        acked = len(self.latencies)
+        print(f"acknowledged  : {acked} ({len(self._pending)} unanswered)")
+        if acked:
+            latencies = sorted(self.latencies)
+            for label, quantile in (
+                ("p50", 0.5),
+                ("p90", 0.9),
+                ("p99", 0.99),
+                ("p99.9", 0.999),
+            ):
+                value = latencies[min(int(quantile * acked), acked - 1)]
+                print(f"ACK {label:<9} : {value * 1000:.3f} ms")
+            print(f"ACK max       : {latencies[-1] * 1000:.3f} ms")
+
+
+# ---------------------------------------------------------------------------
+# replay
+# ---------------------------------------------------------------------------
+
+
+def replay(path: str, target: tuple[str, int], speed: float) -> None:
+    generator = LoadGenerator(target)
+    start = time.monotonic()
+    first = None
+    for timestamp, direction, data in gwmp_capture.read_capture(path):
+        if direction != gwmp_capture.FROM_FORWARDER:
+            continue
+        if first is None:
+            first = timestamp
+        if speed > 0:
+            due = start + (timestamp - first) / speed
+            generator.poll(due - time.monotonic())
+        generator.send(data)
+    elapsed = time.monotonic() - start
+    generator.poll(DRAIN_TIMEOUT)
+    generator.report(elapsed)
+
+
+# ---------------------------------------------------------------------------
+# emulate
+# ---------------------------------------------------------------------------
+
+
+class EmulatedGateway:
+    """Builds lora_pkt_fwd-like GWMP frames for one gateway EUI."""
+
+    def __init__(self, rxpk_count: int) -> None:
+        self.eui = b"\xaa\x55\x5a\xff\xfe" + os.urandom(3)
+        self._rxpk_count = rxpk_count
+        self._fcnt = 0
+        self._next_keepalive = 0.0
+        self._next_stat = 0.0
+
+    def _header(self, pkt_type: int) -> bytes:
+        token = random.getrandbits(16)
+        return struct.pack(">BHB", 2, token, pkt_type) + self.eui
+
+    def _phy_payload(self) -> bytes:
+        # Unconfirmed data up, DevAddr in NetID 0x13 (TTN), FPort 1
+        self._fcnt = (self._fcnt + 1) & 0xFFFF
+        dev_addr = 0x26000000 | random.getrandbits(25)
+        frame = (
+            b"\x40"
+            + struct.pack("<IBH", dev_addr, 0, self._fcnt)
+            + b"\x01"
+            + os.urandom(12)
+            + os.urandom(4)
+        )
+        return frame
+
+    def _rxpk(self) -> dict:
+        frame = self._phy_payload()
+        return {
+            "jver": 1,
+            "tmst": int(time.monotonic() * 1e6) & 0xFFFFFFFF,
+            "chan": random.randrange(8),
+            "rfch": random.randrange(2),
+            "freq": 867.1 + 0.2 * random.randrange(8),
+            "mid": 8,
+            "stat": 1,
+            "modu": "LORA",
+            "datr": "SF7BW125",
+            "codr": "4/5",
+            "rssi": random.randint(-120, -40),
+            "lsnr": round(random.uniform(-10, 10), 1),
+            "size": len(frame),
+            "data": base64.b64encode(frame).decode(),
+        }
+
+    def uplink(self) -> bytes:
+        payload = {"rxpk": [self._rxpk() for _ in range(self._rxpk_count)]}
+        return (
+            self._header(PUSH_DATA)
+            + json.dumps(payload, separators=(",", ":")).encode()
+        )
+
+    def periodic(self, now: float) -> list[bytes]:
+        """Keepalive and stat frames that are due at `now`."""
+        frames = []
+        if now >= self._next_keepalive:
+            self._next_keepalive = now + KEEPALIVE_INTERVAL
+            frames.append(self._header(PULL_DATA))
+        if now >= self._next_stat:
+            self._next_stat = now + STAT_INTERVAL
+            stat = {
+                "stat": {
+                    "time": time.strftime("%Y-%m-%d %H:%M:%S GMT"),
+                    "lati": 52.52,
+                    "long": 13.405,
+                    "alti": 34,
+                    "rxnb": 0,
+                    "rxok": 0,
+                    "rxfw": 0,
+                    "ackr": 100.0,
+                    "dwnb": 0,
+                    "txnb": 0,
+                }
+            }
+            frames.append(
+                self._header(PUSH_DATA)
+                + json.dumps(stat, separators=(",", ":")).encode()
+            )
+        return frames
+
+
+def emulate(
+    target: tuple[str, int],
+    gateway_count: int,
+    rate: float,
+    rxpk_count: int,
+    duration: float,
+) -> None:
+    generator = LoadGenerator(target)
+    gateways = [EmulatedGateway(rxpk_count) for _ in range(gateway_count)]
+    interval = 1.0 / rate if rate > 0 else 0.0
+    start = time.monotonic()
+    end = start + duration
+    next_uplink = start
+    index = 0
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        for gateway in gateways:
+            for frame in gateway.periodic(now):
+                generator.send(frame)
+        if interval:
+            generator.poll(next_uplink - now)
+            next_uplink += interval
+        else:
+            generator.poll(0)
+        generator.send(gateways[index % gateway_count].uplink())
+        index += 1
+    elapsed = time.monotonic() - start
+    generator.poll(DRAIN_TIMEOUT)
+    generator.report(elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--target",
+        type=_parse_target,
+        default=("127.0.0.1", 1700),
+        help="host:port of gwmp_mux or message_collector (127.0.0.1:1700)",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = commands.add_parser("replay", help="replay a capture")
+    replay_parser.add_argument("capture", help="file from MUX_CAPTURE_FILE")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="1 = real time, N = N times faster, 0 = max speed (default: 1)",
+    )
+
+    emulate_parser = commands.add_parser(
+        "emulate", help="synthetic lora_pkt_fwd traffic"
+    )
+    emulate_parser.add_argument("--gateways", type=int, default=1)
+    emulate_parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="uplink PUSH_DATA per second over all gateways, 0 = max",
+    )
+    emulate_parser.add_argument(
+        "--rxpk", type=int, default=1, help="rxpk entries per PUSH_DATA"
+    )
+    emulate_parser.add_argument(
+        "--duration", type=float, default=10.0, help="seconds"
+    )
+
+    args = parser.parse_args()
+    if args.command == "replay":
+        replay(args.capture, args.target, args.speed)
+    else:
+        emulate(
+            args.target, args.gateways, args.rate, args.rxpk, args.duration
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!venv/bin/python3
+"""
+Parses LoRaWAN PHYPayloads into the messageInfo dict of decoders_api.js
+and verifies and decrypts LoRaWAN 1.0.x data frames.
+
+parse_message_info() returns the same keys and values as the Node.js
+/info endpoint (lora-packet fromWire), so message_processor can do without
+the HTTP round-trip. Keys lora-packet leaves undefined (e.g. devAddr of a
+Join Request) are omitted, like in the JSON response of the endpoint.
+decrypt_frm_payload() does what the /decrypt endpoint does: MIC check with
+the NwkSKey, then FRMPayload decryption with the AppSKey (NwkSKey on
+FPort 0). Like lora-packet, it uses the 16-bit FCnt of the frame.
+
+Run as a script to compare both parsers on recorded frames:
+    venv/bin/python3 lorawan_frame.py [messages.db | capture.bin]
+The frames are taken from lorawan_messages (default: DB_DIR/messages.db)
+or from the PUSH_DATA frames of a gwmp_mux capture file.
+"""
+
+import base64
+import binascii
+import json
+import sqlite3
+import sys
+import threading
+from functools import lru_cache
+from typing import Literal
+
+from cryptography.hazmat.primitives import cmac
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+MTYPE_NAMES = (
+    "Join Request",
+    "Join Accept",
+    "Unconfirmed Data Up",
+    "Unconfirmed Data Down",
+    "Confirmed Data Up",
+    "Confirmed Data Down",
+    "Rejoin Request",
+    "Proprietary",
+)
+JOIN_REQUEST = 0
+JOIN_ACCEPT = 1
+DATA_MTYPES = (2, 3, 4, 5)
+# As lora-packet getDir(): "up" for even MTypes up to 5, null above, which
+# /info reports as "downlink". A Rejoin Request (6) is sent uplink, but it
+# is reported as "downlink" here as well to keep parity with /info.
+UPLINK_MTYPES = (0, 2, 4)
+
+# MHDR + FHDR without FOpts + MIC
+MIN_DATA_LENGTH = 12
+
+
+def to_bytes(
+    raw_message: str, message_format: Literal["hex", "base64"]
+) -> bytes:
+    try:
+        if message_format == "base64":
+            return base64.b64decode(raw_message)
+        return bytes.fromhex(raw_message)
+    except (ValueError, binascii.Error) as exc:
+        raise ValueError(f"Invalid {message_format} payload: {exc}")
+
+
+def parse_message_info(phy_payload: bytes) -> dict:
+    """messageInfo of a PHYPayload, raises ValueError if it is too short."""
+    if len(phy_payload) < 5:
+        raise ValueError("PHYPayload is too short")
+    mtype = phy_payload[0] >> 5
+    mac_payload = phy_payload[1:-4]
+    info = {"rawMessage": phy_payload.hex()}
+
+    if mtype in DATA_MTYPES:
+        if len(phy_payload) < MIN_DATA_LENGTH:
+            raise ValueError("PHYPayload is too short for a data frame")
+        f_opts_len = mac_payload[4] & 0x0F
+        fhdr_length = 7 + f_opts_len
+        f_port = mac_payload[fhdr_length : fhdr_length + 1]
+        info["devAddr"] = mac_payload[3::-1].hex()
+        info["fPort"] = f_port[0] if f_port else None
+        info["fCnt"] = mac_payload[5] | mac_payload[6] << 8
+    else:
+        if mtype == JOIN_ACCEPT and len(mac_payload) >= 10:
+            info["devAddr"] = mac_payload[9:5:-1].hex()
+        info["fPort"] = None
+        info["fCnt"] = None
+
+    info["mic"] = phy_payload[-4:].hex()
+    info["mType"] = MTYPE_NAMES[mtype]
+    info["direction"] = "uplink" if mtype in UPLINK_MTYPES else "downlink"
+    if mtype in DATA_MTYPES:
+        info["frmPayload"] = mac_payload[fhdr_length + 1 :].hex()
+    info["macPayload"] = mac_payload.hex()
+    if mtype in DATA_MTYPES:
+        info["fCtrl"] = mac_payload[4:5].hex()
+        info["fOpts"] = mac_payload[7:fhdr_length].hex()
+    info["mhdr"] = phy_payload[:1].hex()
+    return info
+
+
+@lru_cache(maxsize=1024)
+def _keys(key_hex: str, thread_id: int) -> tuple:
+    """AES-ECB encryptor and CMAC context of a session key.
+
+    Both keep their key schedule, so they are reused across frames. The
+    contexts are not thread-safe, hence one set per thread.
+    """
+    key = algorithms.AES(bytes.fromhex(key_hex))
+    return Cipher(key, modes.ECB()).encryptor(), cmac.CMAC(key)
+
+
+def _block(
+    block_type: int, uplink: bool, dev_addr: bytes, f_cnt: int, last: int
+) -> bytes:
+    # B0 (MIC) and Ai (encryption) blocks of LoRaWAN 1.0.x, section 4.3.3
+    return (
+        bytes((block_type, 0, 0, 0, 0, 0 if uplink else 1))
+        + dev_addr
+        + f_cnt.to_bytes(4, "little")
+        + bytes((0, last))
+    )
+
+
+def decrypt_frm_payload(
+    phy_payload: bytes, app_s_key: str, nwk_s_key: str
+) -> str | None:
+    """Decrypted FRMPayload as hex, None if the MIC does not match."""
+    mtype = phy_payload[0] >> 5
+    if mtype not in DATA_MTYPES or len(phy_payload) < MIN_DATA_LENGTH:
+        return None
+    uplink = mtype in UPLINK_MTYPES
+    dev_addr = phy_payload[1:5]
+    f_cnt = phy_payload[6] | phy_payload[7] << 8
+    message = phy_payload[:-4]
+
+    thread_id = threading.get_ident()
+    _, mic_context = _keys(nwk_s_key, thread_id)
+    mic = mic_context.copy()
+    mic.update(_block(0x49, uplink, dev_addr, f_cnt, len(message)))
+    mic.update(message)
+    if mic.finalize()[:4] != phy_payload[-4:]:
+        return None
+
+    fhdr_length = 8 + (phy_payload[5] & 0x0F)
+    frm_payload = message[fhdr_length + 1 :]
+    if not frm_payload:
+        return ""
+    f_port = message[fhdr_length]
+    encryptor, _ = _keys(nwk_s_key if f_port == 0 else app_s_key, thread_id)
+    blocks = b"".join(
+        _block(0x01, uplink, dev_addr, f_cnt, _index + 1)
+        for _index in range((len(frm_payload) + 15) // 16)
+    )
+    key_stream = encryptor.update(blocks)
+    return bytes(
+        _byte ^ _key for _byte, _key in zip(frm_payload, key_stream)
+    ).hex()
+
+
+def parse_raw_message(
+    raw_message: str, message_format: Literal["hex", "base64"] = "hex"
+) -> dict:
+    return parse_message_info(to_bytes(raw_message, message_format))
+
+
+def _recorded_frames(path: str) -> list[bytes]:
+    import gwmp_capture
+
+    try:
+        return [
+            bytes.fromhex(_raw)
+            for (_raw,) in sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True
+            ).execute(
+                "SELECT json_extract(payload, '$.rawMessage') "
+                "FROM lorawan_messages WHERE payload IS NOT NULL"
+            )
+            if _raw
+        ]
+    except sqlite3.DatabaseError:
+        pass
+    frames = []
+    for _, direction, data in gwmp_capture.read_capture(path):
+        if direction != gwmp_capture.FROM_FORWARDER or data[3:4] != b"\x00":
+            continue
+        try:
+            payload = json.loads(data[12:])
+        except ValueError:
+            continue
+        for _rxpk in payload.get("rxpk", []):
+            frames.append(base64.b64decode(_rxpk.get("data", "")))
+    return frames
+
+
+def main() -> None:
+    # imported here: only the parity check needs them, and
+    # message_processor itself imports this module
+    from message_database import DB_NAME
+    from message_processor import BASE_URL, DECODER_TIMEOUT, create_session
+
+    path = sys.argv[1] if len(sys.argv) > 1 else DB_NAME
+    frames = _recorded_frames(path)
+    # same transport as message_processor, TCP or DECODER_SOCKET
+    session = create_session()
+    mismatches = 0
+    for frame in frames:
+        response = session.post(
+            f"{BASE_URL}/info/hex",
+            json={"payload": frame.hex()},
+            timeout=DECODER_TIMEOUT,
+        )
+        try:
+            local = parse_message_info(frame)
+        except ValueError as exc:
+            local = exc
+        if response.status_code != 200:
+            if isinstance(local, ValueError):
+                continue
+            remote = f"HTTP {response.status_code}"
+        else:
+            remote = response.json()
+        if local != remote:
+            mismatches += 1
+            print(f"{frame.hex()}\n  python: {local}\n  node:   {remote}")
+    print(f"{len(frames)} frames compared, {mismatches} mismatches")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,546 @@
 #!venv/bin/python3
-import socket
+import asyncio
+import base64
+import hashlib
 import json
+import multiprocessing
 import os
+import signal
+import time
 import redis
-from semtech_udp import process_message as process_udp_message
+from redis import asyncio as aioredis
+from semtech_udp import parse_header_fast, parse_payload
 
 redis_host = os.environ.get("REDIS_HOST", "127.0.0.1")
 redis_port = int(os.environ.get("REDIS_PORT", 6379))
-redis_connection = redis.Redis(host=redis_host, port=redis_port)
 
 UDP_IP = os.environ.get("COLLECTOR_HOST", "127.0.0.1")
 UDP_PORT = int(os.environ.get("COLLECTOR_PORT", 1701))
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((UDP_IP, UDP_PORT))
-print(f"Listening for LoRaWAN packets on {UDP_IP}:{UDP_PORT}...")
+# Datagrams waiting for Redis. Receiving continues while Redis is slow or
+# unavailable; only when this many are queued are new datagrams dropped.
+QUEUE_SIZE = int(os.environ.get("COLLECTOR_QUEUE_SIZE", 10000))
+# Max. datagrams whose publishes are sent in one pipeline round-trip
+PIPELINE_SIZE = 64
+REDIS_RETRY_INTERVAL = 1.0
 
+# "pubsub" publishes rxpk to the channel, "stream" appends them to a Redis
+# stream of the same name that message_handler reads with a consumer group.
+RXPK_TRANSPORT = os.environ.get("RXPK_TRANSPORT", "pubsub")
+RXPK_STREAM = "rxpk"
+# approximate upper bound of the stream length, older entries are trimmed
+RXPK_STREAM_MAXLEN = int(os.environ.get("RXPK_STREAM_MAXLEN", 100000))
 
-while True:
-    data, addr = sock.recvfrom(4096)
-    message_data = process_udp_message(data)
-    if message_data.get("header", {}).get("message_type") != 0:
-        continue
-    gateway_eui = message_data["header"].get("gateway_id")
-    json_payload = message_data["payload"]
+# Optional NetID prefilter: comma-separated NwkIDs to keep, e.g. "19" for
+# TTN. Data frames with a DevAddr of any other network are dropped before
+# they reach Redis; join and proprietary frames always pass. Empty = off.
+NWK_IDS = {
+    int(_nwk_id)
+    for _nwk_id in os.environ.get("COLLECTOR_NWK_IDS", "").split(",")
+    if _nwk_id.strip()
+}
+STATS_KEY = "collector_stats"
+STATS_INTERVAL = 10
+STATS_FIELDS = ("received", "queue_dropped", "netid_filtered", "duplicates")
+
+# Optional duplicate suppression: copies of the same PHYPayload received by
+# several gateways within this window are published as one rxpk carrying
+# the metadata of all copies in "gateways". 0 = off. Keep it well below
+# the spacing of NbTrans retransmissions, which repeat identical frames.
+DEDUP_WINDOW = int(os.environ.get("COLLECTOR_DEDUP_WINDOW_MS", 0)) / 1000
+# Lifetime of the Redis keys that coordinate workers (ms): the window plus
+# a margin for the owner to collect the metadata. The owner deletes them
+# once it published, so later copies start a new window like in a single
+# process.
+DEDUP_TTL_MARGIN_MS = 200
+DEDUP_TTL_MS = int(DEDUP_WINDOW * 1000) + DEDUP_TTL_MARGIN_MS
+# Per-gateway fields of an rxpk kept for every copy
+GATEWAY_FIELDS = (
+    "gateway_eui",
+    "gateway_location",
+    "tmst",
+    "time",
+    "chan",
+    "rfch",
+    "rssi",
+    "rssis",
+    "lsnr",
+    "foff",
+)
+
+# Number of collector processes. With more than one, a supervisor starts
+# them with SO_REUSEPORT on the same port, lets the kernel distribute the
+# datagrams, restarts workers that die and flushes their summed counters.
+WORKERS = int(os.environ.get("COLLECTOR_WORKERS", 1))
+SUPERVISOR_CHECK_INTERVAL = 1.0
+
+# How often the subscriber count of gateway_push_data is checked
+SUBSCRIBER_CHECK_INTERVAL = 5.0
+
+# MHDR MType values of data frames, which carry a DevAddr
+DATA_MTYPES = {2, 3, 4, 5}
+
+
+def extract_nwkid(data: str) -> int | None:
+    """NwkID of the DevAddr in a base64 PHYPayload, None if it has none.
+
+    Only the first 6 bytes (MHDR, DevAddr, FCtrl) are decoded. The result
+    matches message_processor.extract_nwkid: (dev_addr >> 25) & 0x7F.
+    """
+    try:
+        head = base64.b64decode(data[:8])
+    except ValueError:
+        return None
+    if len(head) < 5 or head[0] >> 5 not in DATA_MTYPES:
+        return None
+    dev_addr = int.from_bytes(head[1:5], "little")
+    return (dev_addr >> 25) & 0x7F
+
+
+def keep_rxpk(rxpk: dict) -> bool:
+    nwk_id = extract_nwkid(rxpk.get("data", ""))
+    return nwk_id is None or nwk_id in NWK_IDS
+
+
+class CollectorProtocol(asyncio.DatagramProtocol):
+    """Moves datagrams from the socket into the bounded queue."""
+
+    def __init__(self, queue: asyncio.Queue, stats: dict) -> None:
+        self._queue = queue
+        self._stats = stats
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self._stats["received"] += 1
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self._stats["queue_dropped"] += 1
+
+
+class GpsCache:
+    """Latest gateway position, kept current from the gps_poller channel."""
+
+    def __init__(self, redis_connection: aioredis.Redis) -> None:
+        self._redis = redis_connection
+        self.location: dict | None = None
+
+    def _update(self, raw: bytes) -> None:
+        data = json.loads(raw)
+        if data.get("lat") is None or data.get("lon") is None:
+            return
+        self.location = {
+            "lat": data["lat"],
+            "lon": data["lon"],
+            "alt": data.get("alt"),
+        }
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with self._redis.pubsub(
+                    ignore_subscribe_messages=True
+                ) as pubsub:
+                    await pubsub.subscribe("gps")
+                    if self.location is None:
+                        gps_raw = await self._redis.get("gps_latest")
+                        if gps_raw:
+                            self._update(gps_raw)
+                    async for message in pubsub.listen():
+                        self._update(message["data"])
+            except (aioredis.RedisError, ValueError) as exc:
+                print(f"GPS subscription failed: {exc}")
+                await asyncio.sleep(REDIS_RETRY_INTERVAL)
+
+
+class AdaptivePublisher:
+    """Subscriber counts of channels, refreshed with PUBSUB NUMSUB.
+
+    Messages for channels without subscribers need neither be serialized
+    nor published. Pattern subscriptions are not counted by NUMSUB. Until
+    the first check succeeds, every channel counts as subscribed.
+    """
+
+    def __init__(
+        self, redis_connection: aioredis.Redis, channels: list[str]
+    ) -> None:
+        self._redis = redis_connection
+        self._channels = channels
+        self._subscribers = {_channel: 1 for _channel in channels}
+
+    def wanted(self, channel: str) -> bool:
+        return self._subscribers.get(channel, 1) > 0
+
+    async def run(self) -> None:
+        while True:
+            try:
+                for _channel, _count in await self._redis.pubsub_numsub(
+                    *self._channels
+                ):
+                    if isinstance(_channel, bytes):
+                        _channel = _channel.decode()
+                    self._subscribers[_channel] = _count
+            except aioredis.RedisError as exc:
+                print(f"Subscriber check failed: {exc}")
+            await asyncio.sleep(SUBSCRIBER_CHECK_INTERVAL)
+
+
+class Deduplicator:
+    """Merges the copies of an uplink received by several gateways.
+
+    The first copy of a PHYPayload is held back for DEDUP_WINDOW, copies
+    arriving meanwhile only add their gateway metadata to it. When several
+    worker processes share the port, the owner of a frame is elected with
+    SET NX in Redis; the other workers hand their metadata to the owner
+    through a Redis list instead of publishing.
+    """
+
+    def __init__(
+        self,
+        window: float,
+        stats: dict,
+        redis_connection: aioredis.Redis | None = None,
+    ) -> None:
+        self._window = window
+        self._stats = stats
+        self._redis = redis_connection
+        # PHYPayload → (deadline, first rxpk), in order of arrival
+        self._pending: dict[str, tuple[float, dict]] = {}
+        self._unclaimed: list[str] = []
+
+    @staticmethod
+    def _redis_key(data: str) -> str:
+        digest = hashlib.blake2b(data.encode(), digest_size=12).hexdigest()
+        return f"collector_dedup:{digest}"
+
+    def add(self, rxpk: dict, now: float) -> None:
+        data = rxpk.get("data", "")
+        metadata = {
+            _field: rxpk[_field] for _field in GATEWAY_FIELDS if _field in rxpk
+        }
+        pending = self._pending.get(data)
+        if pending is not None:
+            pending[1]["gateways"].append(metadata)
+            self._stats["duplicates"] += 1
+            return
+        rxpk["gateways"] = [metadata]
+        self._pending[data] = (now + self._window, rxpk)
+        if self._redis is not None:
+            self._unclaimed.append(data)
+
+    def timeout(self, now: float) -> float | None:
+        """Seconds until the oldest pending frame is due."""
+        oldest = next(iter(self._pending.values()), None)
+        if oldest is None:
+            return None
+        return max(oldest[0] - now, 0)
+
+    async def claim(self) -> None:
+        """Elect the owners of newly seen frames across workers."""
+        if not self._unclaimed:
+            return
+        unclaimed, self._unclaimed = self._unclaimed, []
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for data in unclaimed:
+                    pipe.set(
+                        self._redis_key(data), 1, nx=True, px=DEDUP_TTL_MS
+                    )
+                owned = await pipe.execute()
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for data, is_owner in zip(unclaimed, owned):
+                    if is_owner or data not in self._pending:
+                        continue
+                    _, rxpk = self._pending.pop(data)
+                    self._stats["duplicates"] += len(rxpk["gateways"])
+                    key = self._redis_key(data) + ":gateways"
+                    pipe.rpush(key, *map(json.dumps, rxpk["gateways"]))
+                    pipe.pexpire(key, DEDUP_TTL_MS)
+                await pipe.execute()
+        except aioredis.RedisError as exc:
+            # Publish what is held locally; copies may be duplicated.
+            print(f"Redis deduplication failed: {exc}")
+
+    async def pop_due(self, now: float) -> list[dict]:
+        """The merged rxpk of all frames whose window has passed."""
+        due = []
+        for data, (deadline, rxpk) in self._pending.items():
+            if deadline > now:
+                break
+            due.append((data, rxpk))
+        for data, _ in due:
+            del self._pending[data]
+        if self._redis is not None and due:
+            try:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    for data, _ in due:
+                        key = self._redis_key(data)
+                        pipe.lrange(key + ":gateways", 0, -1)
+                        pipe.delete(key + ":gateways", key)
+                    results = await pipe.execute()
+                for (_, rxpk), remote in zip(due, results[::2]):
+                    rxpk["gateways"] += map(json.loads, remote)
+            except aioredis.RedisError as exc:
+                print(f"Redis deduplication failed: {exc}")
+        return [rxpk for _, rxpk in due]
+
+
+def build_publishes(
+    data: bytes,
+    gateway_location: dict | None,
+    stats: dict,
+    publish_push_data: bool = True,
+    dedup: Deduplicator | None = None,
+) -> list[tuple[str, str]]:
+    """(channel, message) pairs to publish for one datagram."""
+    try:
+        header = parse_header_fast(data)
+        if header.message_type != 0:
+            return []
+        json_payload = parse_payload(data)
+    except ValueError:
+        return []
+    gateway_eui = header.gateway_eui
     rxpk_list = json_payload.get("rxpk", [])
-    gps_raw = redis_connection.get("gps_latest")
-    gateway_location = json.loads(gps_raw) if gps_raw else None
+    if NWK_IDS and rxpk_list:
+        kept = [_rxpk for _rxpk in rxpk_list if keep_rxpk(_rxpk)]
+        stats["netid_filtered"] += len(rxpk_list) - len(kept)
+        rxpk_list = json_payload["rxpk"] = kept
+    publishes = []
     for _rxpk in rxpk_list:
         if gateway_eui:
             _rxpk["gateway_eui"] = gateway_eui
         if gateway_location:
             _rxpk["gateway_location"] = gateway_location
-        _json_rxpk = json.dumps(_rxpk)
-        redis_connection.publish("rxpk", _json_rxpk)
-    redis_connection.publish("gateway_push_data", json.dumps(message_data))
+        if dedup is not None:
+            # published by publish_loop once the window has passed
+            dedup.add(_rxpk, time.monotonic())
+        else:
+            publishes.append(("rxpk", json.dumps(_rxpk)))
+    if publish_push_data:
+        message_data = {"header": header.as_dict(), "payload": json_payload}
+        publishes.append(("gateway_push_data", json.dumps(message_data)))
+    return publishes
+
+
+class SharedStats:
+    """Counters of one worker in memory shared with the supervisor."""
+
+    def __init__(self, counters, worker: int) -> None:
+        self._counters = counters
+        self._offset = worker * len(STATS_FIELDS)
+
+    def add(self, stats: dict) -> None:
+        with self._counters.get_lock():
+            for _index, _field in enumerate(STATS_FIELDS):
+                self._counters[self._offset + _index] += stats[_field]
+
+
+async def publish_loop(
+    queue: asyncio.Queue,
+    redis_connection: aioredis.Redis,
+    gps: GpsCache,
+    publisher: AdaptivePublisher,
+    stats: dict,
+    shared_stats: SharedStats | None = None,
+    dedup: Deduplicator | None = None,
+) -> None:
+    next_stats = time.monotonic() + STATS_INTERVAL
+    while True:
+        if queue.empty():
+            timeout = STATS_INTERVAL
+            if dedup is not None:
+                dedup_timeout = dedup.timeout(time.monotonic())
+                if dedup_timeout is not None:
+                    timeout = min(timeout, dedup_timeout)
+            try:
+                # wake up for due frames and to flush counters when idle
+                datagrams = [await asyncio.wait_for(queue.get(), timeout)]
+            except asyncio.TimeoutError:
+                datagrams = []
+        else:
+            datagrams = [queue.get_nowait()]
+        while len(datagrams) < PIPELINE_SIZE and not queue.empty():
+            datagrams.append(queue.get_nowait())
+        publishes = []
+        publish_push_data = publisher.wanted("gateway_push_data")
+        for data in datagrams:
+            publishes += build_publishes(
+                data, gps.location, stats, publish_push_data, dedup
+            )
+        if dedup is not None:
+            await dedup.claim()
+            for _rxpk in await dedup.pop_due(time.monotonic()):
+                publishes.append(("rxpk", json.dumps(_rxpk)))
+        flush_stats = time.monotonic() >= next_stats and any(stats.values())
+        if flush_stats and shared_stats is not None:
+            # the supervisor writes the sum of all workers to Redis
+            shared_stats.add(stats)
+            next_stats = time.monotonic() + STATS_INTERVAL
+            for field in stats:
+                stats[field] = 0
+            flush_stats = False
+        if not publishes and not flush_stats:
+            continue
+        while True:
+            try:
+                async with redis_connection.pipeline(
+                    transaction=False
+                ) as pipe:
+                    for channel, message in publishes:
+                        if (
+                            channel == RXPK_STREAM
+                            and RXPK_TRANSPORT == "stream"
+                        ):
+                            pipe.xadd(
+                                RXPK_STREAM,
+                                {"data": message},
+                                maxlen=RXPK_STREAM_MAXLEN,
+                                approximate=True,
+                            )
+                        else:
+                            pipe.publish(channel, message)
+                    if flush_stats:
+                        for field, count in stats.items():
+                            if count:
+                                pipe.hincrby(STATS_KEY, field, count)
+                    await pipe.execute()
+                break
+            except aioredis.RedisError as exc:
+                # The queue keeps receiving meanwhile.
+                print(f"Redis publish failed, retrying: {exc}")
+                await asyncio.sleep(REDIS_RETRY_INTERVAL)
+        if flush_stats:
+            next_stats = time.monotonic() + STATS_INTERVAL
+            for field in stats:
+                stats[field] = 0
+
+
+def print_settings() -> None:
+    if NWK_IDS:
+        print(f"Forwarding data frames of NwkIDs {sorted(NWK_IDS)} only")
+    if RXPK_TRANSPORT == "stream":
+        print(f"Appending rxpk to Redis stream {RXPK_STREAM}")
+    if DEDUP_WINDOW > 0:
+        print(f"Merging duplicates within {DEDUP_WINDOW * 1000:.0f} ms")
+
+
+async def main(worker: int | None = None, counters=None) -> None:
+    redis_connection = aioredis.Redis(host=redis_host, port=redis_port)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    stats = dict.fromkeys(STATS_FIELDS, 0)
+    shared_stats = None if worker is None else SharedStats(counters, worker)
+    gps = GpsCache(redis_connection)
+    publisher = AdaptivePublisher(redis_connection, ["gateway_push_data"])
+    dedup = None
+    if DEDUP_WINDOW > 0:
+        # other workers only exist with SO_REUSEPORT
+        dedup = Deduplicator(
+            DEDUP_WINDOW,
+            stats,
+            redis_connection if worker is not None else None,
+        )
+
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(
+        lambda: CollectorProtocol(queue, stats),
+        local_addr=(UDP_IP, UDP_PORT),
+        reuse_port=worker is not None,
+    )
+    if worker is not None:
+        print(f"Worker {worker} (pid {os.getpid()}) listening...")
+    else:
+        print(f"Listening for LoRaWAN packets on {UDP_IP}:{UDP_PORT}...")
+        print_settings()
+
+    await asyncio.gather(
+        gps.run(),
+        publisher.run(),
+        publish_loop(
+            queue,
+            redis_connection,
+            gps,
+            publisher,
+            stats,
+            shared_stats,
+            dedup,
+        ),
+    )
+
+
+def run_worker(worker: int, counters) -> None:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(main(worker, counters))
+
+
+def _exit(signum, frame):
+    raise SystemExit(0)
+
+
+def supervise(worker_count: int) -> None:
+    context = multiprocessing.get_context("fork")
+    counters = context.Array("q", worker_count * len(STATS_FIELDS))
+    redis_connection = redis.Redis(host=redis_host, port=redis_port)
+    processes: list = [None] * worker_count
+    flushed = [0] * len(STATS_FIELDS)
+    next_stats = time.monotonic() + STATS_INTERVAL
+    signal.signal(signal.SIGTERM, _exit)
+
+    print(
+        f"Listening for LoRaWAN packets on {UDP_IP}:{UDP_PORT} "
+        f"with {worker_count} workers..."
+    )
+    print_settings()
+    try:
+        while True:
+            for _worker, _process in enumerate(processes):
+                if _process is not None and _process.is_alive():
+                    continue
+                if _process is not None:
+                    print(
+                        f"Worker {_worker} exited with code "
+                        f"{_process.exitcode}, restarting"
+                    )
+                _process = context.Process(
+                    target=run_worker,
+                    args=(_worker, counters),
+                    name=f"collector-{_worker}",
+                    daemon=True,
+                )
+                _process.start()
+                processes[_worker] = _process
+            if time.monotonic() >= next_stats:
+                next_stats = time.monotonic() + STATS_INTERVAL
+                with counters.get_lock():
+                    totals = [
+                        sum(counters[_index :: len(STATS_FIELDS)])
+                        for _index in range(len(STATS_FIELDS))
+                    ]
+                try:
+                    with redis_connection.pipeline(transaction=False) as pipe:
+                        for _field, _total, _flushed in zip(
+                            STATS_FIELDS, totals, flushed
+                        ):
+                            if _total > _flushed:
+                                pipe.hincrby(
+                                    STATS_KEY, _field, _total - _flushed
+                                )
+                        pipe.execute()
+                    flushed = totals
+                except redis.RedisError as exc:
+                    print(f"Redis stats update failed: {exc}")
+            time.sleep(SUPERVISOR_CHECK_INTERVAL)
+    finally:
+        for _process in processes:
+            if _process is not None:
+                _process.terminate()
+        for _process in processes:
+            if _process is not None:
+                _process.join(timeout=5)
+
+
+if __name__ == "__main__":
+    if WORKERS > 1:
+        supervise(WORKERS)
+    else:
+        asyncio.run(main())
@@ -1,5 +1,8 @@
 import json
 import struct
+from collections.abc import Iterator
+
+import orjson
 
 MESSAGE_TYPES = {
     0x00: "Push Data",
@@ -10,6 +13,54 @@ MESSAGE_TYPES = {
     0x05: "TX Ack",
 }
 
+HEADER = struct.Struct(">BHB8s")
+
+
+class Header:
+    """
+    Semtech UDP header as parsed by parse_header_fast.
+
+    The gateway ID is kept as raw bytes; its hex string and the message
+    type description are only computed when accessed.
+    """
+
+    __slots__ = (
+        "protocol_version",
+        "random_token",
+        "message_type",
+        "gateway_id",
+    )
+
+    def __init__(
+        self,
+        protocol_version: int,
+        random_token: int,
+        message_type: int,
+        gateway_id: bytes,
+    ):
+        self.protocol_version = protocol_version
+        self.random_token = random_token
+        self.message_type = message_type
+        self.gateway_id = gateway_id
+
+    @property
+    def gateway_eui(self) -> str:
+        return self.gateway_id.hex()
+
+    @property
+    def message_type_desc(self) -> str:
+        return MESSAGE_TYPES.get(self.message_type, "Unknown")
+
+    def as_dict(self) -> dict:
+        """The header in the format returned by parse_header."""
+        return {
+            "protocol_version": self.protocol_version,
+            "random_token": self.random_token,
+            "message_type": self.message_type,
+            "message_type_desc": self.message_type_desc,
+            "gateway_id": self.gateway_eui,
+        }
+
 
 def parse_header(data: bytes) -> dict:
     """
@@ -49,3 +100,54 @@ def process_message(data: bytes):
             raise ValueError("Invalid JSON payload")
     else:
         return {"header": header}
+
+
+def parse_header_fast(data: bytes) -> Header:
+    """
+    Parse the 12-byte Semtech UDP header without building a dict.
+
+    Args:
+        data (bytes): The raw UDP packet (at least 12 bytes).
+
+    Returns:
+        Header: Parsed header information.
+    """
+    if len(data) < 12:
+        raise ValueError(
+            "Data is too short to contain a valid Semtech UDP header"
+        )
+    return Header(*HEADER.unpack_from(data))
+
+
+def parse_payload(data: bytes) -> dict:
+    """
+    Parse the JSON payload following the header with orjson.
+
+    The payload is read through a memoryview, so it is not copied.
+
+    Args:
+        data (bytes): The raw UDP packet (Push Data or Pull Resp).
+
+    Returns:
+        dict: The decoded JSON object.
+    """
+    try:
+        return orjson.loads(memoryview(data)[12:])
+    except orjson.JSONDecodeError:
+        raise ValueError("Invalid JSON payload")
+
+
+def iter_rxpk(data: bytes) -> Iterator[dict]:
+    """
+    Iterate over the rxpk entries of a Push Data packet.
+
+    The payload is only parsed when the first entry is requested, so
+    packets that are skipped cost nothing beyond the header.
+
+    Args:
+        data (bytes): The raw UDP packet.
+
+    Yields:
+        dict: One received packet (rxpk object) after the other.
+    """
+    yield from parse_payload(data).get("rxpk", ())
@@ -1,10 +1,19 @@
 #!venv/bin/python3
+import logging
 import os
 import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
 
 # DB_DIR can be set to store databases in a specific directory.
 # Defaults to '.' (current working directory).
 DB_NAME = os.path.join(os.getenv("DB_DIR", "."), "messages.db")
+# MessageWriter commits once this many rows are pending ...
+WRITE_BATCH_ROWS = int(os.getenv("DB_WRITE_BATCH_ROWS", 100))
+# ... or the oldest pending row is this old
+WRITE_BATCH_MS = int(os.getenv("DB_WRITE_BATCH_MS", 500))
 
 _SQL_CREATE_LORAWAN_MESSAGES = """
     CREATE TABLE IF NOT EXISTS lorawan_messages (
@@ -177,16 +186,122 @@ def create_database():
                 conn.execute(statement)
 
 
+_SQL_INSERT_LORAWAN_MESSAGE = """
+    INSERT OR IGNORE INTO lorawan_messages (
+        timestamp, gateway_eui, payload)
+    VALUES (?, ?, ?)
+"""
+
+_SQL_INSERT_TTN_STORAGE_MESSAGE = """
+    INSERT OR REPLACE INTO ttn_storage_messages
+        (time, application_id, device_id, data)
+    VALUES (?, ?, ?, ?)
+"""
+
+
 def insert_message(timestamp, gateway_eui, payload):
     with sqlite3.connect(DB_NAME) as conn:
         conn.execute(
-            """
-            INSERT OR IGNORE INTO lorawan_messages (
-                timestamp, gateway_eui, payload)
-            VALUES (?, ?, ?)
-            """,
-            (timestamp, gateway_eui, payload),
+            _SQL_INSERT_LORAWAN_MESSAGE, (timestamp, gateway_eui, payload)
+        )
+
+
+class MessageWriter:
+    """Keeps one connection and commits inserts in batches.
+
+    Rows are buffered and written in one transaction once batch_rows are
+    pending or the oldest is batch_ms old, on flush() and on close(). A
+    batch that fails to commit stays pending and is retried. Thread-safe;
+    use as a context manager or call close() on shutdown.
+    """
+
+    def __init__(
+        self,
+        db_name=DB_NAME,
+        batch_rows=WRITE_BATCH_ROWS,
+        batch_ms=WRITE_BATCH_MS,
+    ):
+        self._conn = sqlite3.connect(db_name, check_same_thread=False)
+        self._batch_rows = batch_rows
+        self._batch_delay = batch_ms / 1000
+        self._pending = {}
+        self._pending_rows = 0
+        self._deadline = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = threading.Thread(
+            target=self._flush_due, name="message-writer", daemon=True
         )
+        self._timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def insert_message(self, timestamp, gateway_eui, payload):
+        self._add(
+            _SQL_INSERT_LORAWAN_MESSAGE, [(timestamp, gateway_eui, payload)]
+        )
+
+    def insert_storage_messages(self, rows):
+        """rows of (time, application_id, device_id, data)"""
+        self._add(_SQL_INSERT_TTN_STORAGE_MESSAGE, rows)
+
+    def _add(self, sql, rows):
+        with self._lock:
+            if self._closed.is_set():
+                raise RuntimeError("MessageWriter is closed")
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self._batch_delay
+            self._pending.setdefault(sql, []).extend(rows)
+            self._pending_rows += len(rows)
+            if self._pending_rows >= self._batch_rows:
+                self._commit()
+
+    def _commit(self):
+        if not self._pending:
+            return
+        with self._conn:
+            for _sql, _rows in self._pending.items():
+                self._conn.executemany(_sql, _rows)
+        self._pending = {}
+        self._pending_rows = 0
+        self._deadline = None
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def _flush_due(self):
+        timeout = self._batch_delay
+        while not self._closed.wait(timeout):
+            with self._lock:
+                if self._deadline is None:
+                    timeout = self._batch_delay
+                    continue
+                timeout = self._deadline - time.monotonic()
+                if timeout > 0:
+                    continue
+                timeout = self._batch_delay
+                try:
+                    self._commit()
+                except sqlite3.Error as exc:
+                    log.warning(
+                        "Commit of %d rows failed: %s", self._pending_rows, exc
+                    )
+
+    def close(self):
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            try:
+                self._commit()
+            finally:
+                self._conn.close()
+        self._timer.join()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,23 @@
 #!venv/bin/python3
+import base64
 import logging
 import json
 import os
+import queue
+import signal
+import socket
+import threading
 import time
+import zlib
 import redis
-from message_processor import process_raw_message
-from message_database import insert_message
-from requests import HTTPError
+from message_processor import decode_cache, process_raw_message
+from device_database import (
+    DECODERS_UPDATED_CHANNEL,
+    SESSIONS_UPDATED_CHANNEL,
+    session_index,
+)
+from message_database import MessageWriter, insert_message
+from requests import RequestException
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -15,38 +26,342 @@ redis_host = os.environ.get("REDIS_HOST", "127.0.0.1")
 redis_port = int(os.environ.get("REDIS_PORT", 6379))
 REDIS_CHANNEL = "rxpk"
 
+# Must match the message_collector setting: "pubsub" or "stream". In stream
+# mode several handlers share the work via the consumer group; entries are
+# acknowledged after processing, so a restart does not lose frames.
+RXPK_TRANSPORT = os.environ.get("RXPK_TRANSPORT", "pubsub")
+RXPK_STREAM = "rxpk"
+RXPK_GROUP = os.environ.get("RXPK_GROUP", "message_handler")
+RXPK_BATCH = int(os.environ.get("RXPK_BATCH", 100))
+RXPK_BLOCK_MS = 5000
+# pending entries of a consumer idle for this long are taken over
+RXPK_CLAIM_IDLE_MS = int(os.environ.get("RXPK_CLAIM_IDLE_MS", 60000))
+
+# Packets decrypted and decoded concurrently. Packets of the same DevAddr
+# stay in one lane and are processed and stored in order of arrival; a
+# single writer thread does all SQLite inserts and publishes. 1 = inline.
+HANDLER_WORKERS = int(os.environ.get("HANDLER_WORKERS", 1))
+# Packets waiting per lane before the Redis reader is held up
+LANE_QUEUE_SIZE = 100
+
 redis_client = redis.Redis(
     host=redis_host, port=redis_port, decode_responses=True
 )
 
+# How often the subscriber counts of the output channels are checked
+SUBSCRIBER_CHECK_INTERVAL = 5.0
+
+# Redis hash the decode cache counters of all handlers are added to
+STATS_KEY = "handler_stats"
+STATS_INTERVAL = 10
+
+
+class AdaptivePublisher:
+    """Publishes only to channels that currently have subscribers.
+
+    Counts come from PUBSUB NUMSUB, refreshed at most every
+    SUBSCRIBER_CHECK_INTERVAL seconds; pattern subscriptions are not
+    counted. Until the first check succeeds, every channel counts as
+    subscribed.
+    """
+
+    def __init__(self, client: redis.Redis, channels: list[str]):
+        self._client = client
+        self._channels = channels
+        self._subscribers = {_channel: 1 for _channel in channels}
+        self._next_check = 0.0
+
+    def wanted(self, channel: str) -> bool:
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + SUBSCRIBER_CHECK_INTERVAL
+            try:
+                self._subscribers.update(
+                    self._client.pubsub_numsub(*self._channels)
+                )
+            except redis.RedisError as exc:
+                log.warning("Subscriber check failed: %s", exc)
+        return self._subscribers.get(channel, 1) > 0
+
+    def publish(self, channel: str, message: str):
+        if self.wanted(channel):
+            self._client.publish(channel, message)
+
+
+publisher = AdaptivePublisher(redis_client, ["ttn_messages", "other_messages"])
+
+
+def build_message(packet: dict, timestamp: float) -> dict | None:
+    """Decrypted and decoded message of an rxpk, None if it has no data."""
+    if "data" not in packet:
+        return None
+    _gateway_eui = packet.get("gateway_eui")
+    try:
+        _message = process_raw_message(packet["data"], "base64")
+    except (RequestException, ValueError):
+        log.error("Problem with: %s", packet)
+        return None
+    _message["receiveTimestamp"] = timestamp
+    if _gateway_eui is not None:
+        _message["gatewayEui"] = _gateway_eui
+    _gateway_location = packet.get("gateway_location")
+    if _gateway_location is not None:
+        _message["gatewayLocation"] = _gateway_location
+    # all receiving gateways when the collector merged duplicates
+    _gateways = packet.get("gateways")
+    if _gateways is not None:
+        _message["gateways"] = _gateways
+    return _message
+
+
+# batches the inserts of lorawan_messages, set in main()
+writer = None
+
+
+def store_message(message: dict):
+    _timestamp = message["receiveTimestamp"]
+    _gateway_eui = message.get("gatewayEui")
+    if message.get("nwkId") == 19:
+        _json_message = json.dumps(message)
+        if writer is not None:
+            writer.insert_message(_timestamp, _gateway_eui, _json_message)
+        else:
+            insert_message(_timestamp, _gateway_eui, _json_message)
+        publisher.publish("ttn_messages", _json_message)
+    elif publisher.wanted("other_messages"):
+        publisher.publish("other_messages", json.dumps(message))
+
+
+def lane_key(packet: dict) -> int:
+    """Hash of the DevAddr of a data frame, of the whole frame otherwise."""
+    _data = packet.get("data", "")
+    try:
+        _head = base64.b64decode(_data[:8])
+    except ValueError:
+        _head = b""
+    if len(_head) >= 5 and _head[0] >> 5 in (2, 3, 4, 5):
+        return zlib.crc32(_head[1:5])
+    return zlib.crc32(_data.encode())
+
+
+class WorkerPool:
+    """Processes packets in parallel lanes, stores them from one thread.
+
+    submit() blocks while the lane of the packet is full, which holds up
+    the reader (backpressure). wait() returns once every packet submitted
+    so far has been stored.
+    """
+
+    def __init__(
+        self, workers: int, process=build_message, store=store_message
+    ):
+        self._process = process
+        self._store = store
+        self._lanes = [
+            queue.Queue(maxsize=LANE_QUEUE_SIZE) for _ in range(workers)
+        ]
+        self._results = queue.Queue(maxsize=LANE_QUEUE_SIZE * workers)
+        for _index, _lane in enumerate(self._lanes):
+            threading.Thread(
+                target=self._work,
+                args=(_lane,),
+                name=f"handler-lane-{_index}",
+                daemon=True,
+            ).start()
+        threading.Thread(
+            target=self._write, name="handler-writer", daemon=True
+        ).start()
+
+    def submit(self, packet: dict):
+        _lane = self._lanes[lane_key(packet) % len(self._lanes)]
+        _lane.put((packet, time.time()))
+
+    def wait(self):
+        for _lane in self._lanes:
+            _lane.join()
+        self._results.join()
+
+    def _work(self, lane: queue.Queue):
+        while True:
+            _packet, _timestamp = lane.get()
+            try:
+                _message = self._process(_packet, _timestamp)
+                if _message is not None:
+                    self._results.put(_message)
+            except Exception:
+                log.exception("Processing failed: %s", _packet)
+            finally:
+                lane.task_done()
+
+    def _write(self):
+        while True:
+            _message = self._results.get()
+            try:
+                self._store(_message)
+            except Exception:
+                log.exception("Storing failed: %s", _message)
+            finally:
+                self._results.task_done()
+
 
 def process_packet(packet: dict):
-    if "data" in packet:
-        _timestamp = time.time()
-        _gateway_eui = packet.get("gateway_eui")
-        try:
-            _message = process_raw_message(packet["data"], "base64")
-        except HTTPError:
-            log.error("Problem with: %s", packet)
+    _message = build_message(packet, time.time())
+    if _message is not None:
+        store_message(_message)
+
+
+pool = None
+
+
+def handle_packet(packet: dict):
+    if pool is not None:
+        pool.submit(packet)
+    else:
+        process_packet(packet)
+
+
+def listen_pubsub():
+    pubsub = redis_client.pubsub()
+    pubsub.subscribe(REDIS_CHANNEL)
+
+    print(f"Listening for messages on Redis channel: {REDIS_CHANNEL}")
+    for message in pubsub.listen():
+        if message["type"] == "message":
+            handle_packet(json.loads(message["data"]))
+
+
+def process_entries(entries: list):
+    for _entry_id, _fields in entries:
+        if _fields and "data" in _fields:
+            handle_packet(json.loads(_fields["data"]))
+    if pool is not None:
+        # acknowledge only what has been stored
+        pool.wait()
+    if writer is not None:
+        writer.flush()
+    if entries:
+        redis_client.xack(
+            RXPK_STREAM, RXPK_GROUP, *[_entry[0] for _entry in entries]
+        )
+
+
+def claim_stale_entries(consumer: str):
+    """Take over entries left pending by handlers that stopped."""
+    start_id = "0-0"
+    while True:
+        start_id, entries, *_ = redis_client.xautoclaim(
+            RXPK_STREAM,
+            RXPK_GROUP,
+            consumer,
+            RXPK_CLAIM_IDLE_MS,
+            start_id=start_id,
+            count=RXPK_BATCH,
+        )
+        if entries:
+            log.info("Claimed %d pending entries", len(entries))
+        process_entries(entries)
+        if start_id == "0-0":
             return
-        _message["receiveTimestamp"] = _timestamp
-        if _gateway_eui is not None:
-            _message["gatewayEui"] = _gateway_eui
-        _gateway_location = packet.get("gateway_location")
-        if _gateway_location is not None:
-            _message["gatewayLocation"] = _gateway_location
-        _json_message = json.dumps(_message)
-        if _message.get("nwkId") == 19:
-            insert_message(_timestamp, _gateway_eui, _json_message)
-            redis_client.publish("ttn_messages", _json_message)
-        else:
-            redis_client.publish("other_messages", _json_message)
 
 
-pubsub = redis_client.pubsub()
-pubsub.subscribe(REDIS_CHANNEL)
+def listen_stream():
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    try:
+        redis_client.xgroup_create(
+            RXPK_STREAM, RXPK_GROUP, id="$", mkstream=True
+        )
+    except redis.ResponseError as exc:
+        if "BUSYGROUP" not in str(exc):
+            raise
+
+    print(
+        f"Reading Redis stream {RXPK_STREAM} as {consumer} "
+        f"in group {RXPK_GROUP}"
+    )
+    next_claim = 0.0
+    while True:
+        if time.monotonic() >= next_claim:
+            claim_stale_entries(consumer)
+            next_claim = time.monotonic() + RXPK_CLAIM_IDLE_MS / 1000
+        response = redis_client.xreadgroup(
+            RXPK_GROUP,
+            consumer,
+            {RXPK_STREAM: ">"},
+            count=RXPK_BATCH,
+            block=RXPK_BLOCK_MS,
+        )
+        for _stream, entries in response:
+            process_entries(entries)
+
+
+def on_sessions_updated(message):
+    log.info("Device sessions updated, reloading on next lookup")
+    session_index.invalidate()
+
+
+def on_decoders_updated(message):
+    _updated = json.loads(message["data"])
+    log.info("%d decoders updated, dropping cached results", len(_updated))
+    for _application_id, _device_id in _updated:
+        decode_cache.invalidate(_application_id, _device_id)
+
+
+def report_stats():
+    """Adds the decode cache counters to STATS_KEY every STATS_INTERVAL."""
+    flushed = {"decode_cache_hits": 0, "decode_cache_misses": 0}
+    while True:
+        time.sleep(STATS_INTERVAL)
+        _current = {
+            "decode_cache_hits": decode_cache.hits,
+            "decode_cache_misses": decode_cache.misses,
+        }
+        try:
+            with redis_client.pipeline(transaction=False) as pipe:
+                for _field, _count in _current.items():
+                    if _count > flushed[_field]:
+                        pipe.hincrby(
+                            STATS_KEY, _field, _count - flushed[_field]
+                        )
+                pipe.execute()
+            flushed = _current
+        except redis.RedisError as exc:
+            log.warning("Stats update failed: %s", exc)
+
+
+def _exit(signum, frame):
+    raise SystemExit(0)
+
+
+def main():
+    global pool, writer
+    signal.signal(signal.SIGTERM, _exit)
+    writer = MessageWriter()
+    if HANDLER_WORKERS > 1:
+        pool = WorkerPool(HANDLER_WORKERS)
+        print(f"Processing with {HANDLER_WORKERS} lanes")
+
+    notifications = redis_client.pubsub(ignore_subscribe_messages=True)
+    notifications.subscribe(
+        **{
+            SESSIONS_UPDATED_CHANNEL: on_sessions_updated,
+            DECODERS_UPDATED_CHANNEL: on_decoders_updated,
+        }
+    )
+    notifications.run_in_thread(sleep_time=1.0, daemon=True)
+    threading.Thread(
+        target=report_stats, name="handler-stats", daemon=True
+    ).start()
+
+    try:
+        if RXPK_TRANSPORT == "stream":
+            listen_stream()
+        else:
+            listen_pubsub()
+    finally:
+        if pool is not None:
+            pool.wait()
+        writer.close()
+
 
-print(f"Listening for messages on Redis channel: {REDIS_CHANNEL}")
-for message in pubsub.listen():
-    if message["type"] == "message":
-        process_packet(json.loads(message["data"]))
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,175 @@
+from collections import OrderedDict
 from typing import Literal
 import os
+import socket
+import threading
 import requests
-from device_database import get_latest_session_by_dev_addr
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.util.retry import Retry
+from device_database import session_index
+import lorawan_frame
 
 decoder_host = os.environ.get("DECODER_HOST", "127.0.0.1")
 decoder_port = int(os.environ.get("DECODER_PORT", 3000))
 BASE_URL = f"http://{decoder_host}:{decoder_port}"
+# Path of the Unix domain socket decoders_api.js listens on (SOCKET_PATH),
+# replaces DECODER_HOST/DECODER_PORT if set.
+DECODER_SOCKET = os.environ.get("DECODER_SOCKET")
+DECODER_TIMEOUT = (
+    float(os.environ.get("DECODER_CONNECT_TIMEOUT", 2.0)),
+    float(os.environ.get("DECODER_READ_TIMEOUT", 10.0)),
+)
+# Retries of failed connections and 502/503/504 responses. The decoder
+# calls are side-effect free, so POST requests are retried as well; a read
+# timeout is not, the decoder is busy then.
+DECODER_RETRIES = int(os.environ.get("DECODER_RETRIES", 2))
+# one connection per concurrent message_handler lane
+DECODER_POOL_SIZE = max(int(os.environ.get("HANDLER_WORKERS", 1)), 4)
+# "python" parses frames with lorawan_frame, "node" asks the decoder API
+INFO_PARSER = os.environ.get("INFO_PARSER", "python")
+# "python" verifies and decrypts with lorawan_frame, "node" posts the frame
+# and session keys to the decoder API
+DECRYPTER = os.environ.get("DECRYPTER", "python")
+# "split" decrypts and decodes in separate steps, "combined" sends the frame
+# and its session keys to /process of the decoder API in a single call. The
+# decode cache is used in both; in combined mode a hit needs the frame to be
+# decrypted locally (DECRYPTER=python) and then skips /process.
+DECODER_MODE = os.environ.get("DECODER_MODE", "split")
+# Decoded payloads kept per (application, device, fPort, payload), 0 = off
+DECODE_CACHE_SIZE = int(os.environ.get("DECODE_CACHE_SIZE", 4096))
+
+
+class _UnixConnection(HTTPConnection):
+    def __init__(self, *args, socket_path: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._socket_path = socket_path
+
+    def _new_conn(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._socket_path)
+        return sock
+
+
+class _UnixConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _UnixConnection
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """Sends all requests of a session to a Unix domain socket."""
+
+    def __init__(self, socket_path: str, **kwargs):
+        super().__init__(**kwargs)
+        self._pool = _UnixConnectionPool(
+            "localhost",
+            maxsize=kwargs.get("pool_maxsize", DECODER_POOL_SIZE),
+            socket_path=socket_path,
+        )
+
+    def get_connection_with_tls_context(
+        self, request, verify, proxies=None, cert=None
+    ):
+        return self._pool
+
+    def get_connection(self, url, proxies=None):
+        return self._pool
+
+    def close(self):
+        super().close()
+        self._pool.close()
+
+
+def create_session(
+    socket_path: str | None = DECODER_SOCKET,
+) -> requests.Session:
+    """Session with keep-alive connections and retries for the decoder API."""
+    retry = Retry(
+        total=DECODER_RETRIES,
+        read=0,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    if socket_path:
+        adapter = UnixSocketAdapter(
+            socket_path, max_retries=retry, pool_maxsize=DECODER_POOL_SIZE
+        )
+    else:
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_maxsize=DECODER_POOL_SIZE
+        )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    return session
+
+
+decoder_session = create_session()
+
+
+def _post(url: str, payload: dict) -> requests.Response:
+    return decoder_session.post(url, json=payload, timeout=DECODER_TIMEOUT)
+
+
+class DecodeCache:
+    """Bounded LRU of decoder results, shared by the handler lanes.
+
+    Keyed by (application_id, device_id, fPort, decrypted hex); the entries
+    of a device are dropped by invalidate() when its decoder was rewritten.
+    hits and misses count the lookups since start; a cache with maxsize 0
+    is off and counts neither.
+    """
+
+    def __init__(self, maxsize: int = DECODE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> dict | None:
+        if self.maxsize <= 0:
+            return None
+        with self._lock:
+            decoded = self._entries.get(key)
+            if decoded is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return decoded
+
+    def put(self, key: tuple, decoded: dict):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = decoded
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, application_id: str, device_id: str):
+        with self._lock:
+            for _key in [
+                _key
+                for _key in self._entries
+                if _key[0] == application_id and _key[1] == device_id
+            ]:
+                del self._entries[_key]
+
+
+decode_cache = DecodeCache()
+
+
+def _decode_key(decrypted_payload: str, message_info: dict) -> tuple:
+    return (
+        message_info["applicationId"],
+        message_info["deviceId"],
+        message_info["fPort"],
+        decrypted_payload,
+    )
 
 
 def extract_nwkid(dev_addr: str) -> int:
@@ -17,21 +181,29 @@ def extract_nwkid(dev_addr: str) -> int:
 def _fetch_message_info(
     raw_message: str, message_format: Literal["hex", "base64"]
 ) -> dict:
+    if INFO_PARSER == "python":
+        return lorawan_frame.parse_raw_message(raw_message, message_format)
     info_url = f"{BASE_URL}/info/{message_format}"
-    response = requests.post(info_url, json={"payload": raw_message})
+    response = _post(info_url, {"payload": raw_message})
     response.raise_for_status()
     return response.json()
 
 
 def _fetch_session_info(dev_addr: str) -> dict | None:
-    return get_latest_session_by_dev_addr(dev_addr.upper())
+    return session_index.get(dev_addr.upper())
 
 
-def _decrypt_message(raw_message: str, session_info: dict) -> dict | None:
+def _decrypt_message(raw_message: str, session_info: dict) -> str | None:
+    if DECRYPTER == "python":
+        return lorawan_frame.decrypt_frm_payload(
+            bytes.fromhex(raw_message),
+            session_info["app_s_key"],
+            session_info["nwk_s_key"],
+        )
     decrypt_url = f"{BASE_URL}/decrypt/hex"
-    response = requests.post(
+    response = _post(
         decrypt_url,
-        json={
+        {
             "payload": raw_message,
             "app_s_key": session_info["app_s_key"],
             "nwk_s_key": session_info["nwk_s_key"],
@@ -42,10 +214,14 @@ def _decrypt_message(raw_message: str, session_info: dict) -> dict | None:
 
 
 def _decode_message(decrypted_payload: str, message_info: dict) -> dict | None:
+    key = _decode_key(decrypted_payload, message_info)
+    decoded = decode_cache.get(key)
+    if decoded is not None:
+        return decoded
     decode_url = f"{BASE_URL}/decode/hex"
-    response = requests.post(
+    response = _post(
         decode_url,
-        json={
+        {
             "payload": decrypted_payload,
             "application": message_info["applicationId"],
             "device": message_info["deviceId"],
@@ -53,24 +229,23 @@ def _decode_message(decrypted_payload: str, message_info: dict) -> dict | None:
         },
     )
     if response.status_code == 200:
-        return response.json()
+        decoded = response.json()
+        if decoded:
+            decode_cache.put(key, decoded)
+        return decoded
 
 
-def process_message(
-    message_info: dict,
-    decrypt_message: bool = True,
-    decode_message: bool = True,
-    ttn_only: bool = True,
-) -> dict:
+def _attach_session(message_info: dict, ttn_only: bool) -> dict | None:
+    """Adds nwkId and the device ids, returns the session if one is known."""
     dev_addr = message_info.get("devAddr")
     if not dev_addr:
-        return message_info
+        return None
     message_info["nwkId"] = extract_nwkid(dev_addr)
     if ttn_only and message_info["nwkId"] != 19:
-        return message_info
+        return None
     session_info = _fetch_session_info(dev_addr)
     if not session_info:
-        return message_info
+        return None
 
     message_info.update(
         {
@@ -79,6 +254,18 @@ def process_message(
             "deviceId": session_info["device_id"],
         }
     )
+    return session_info
+
+
+def process_message(
+    message_info: dict,
+    decrypt_message: bool = True,
+    decode_message: bool = True,
+    ttn_only: bool = True,
+) -> dict:
+    session_info = _attach_session(message_info, ttn_only)
+    if not session_info:
+        return message_info
 
     if decrypt_message:
         decrypted_payload = _decrypt_message(
@@ -97,6 +284,150 @@ def process_message(
     return message_info
 
 
+def _post_batch(url: str, items: list[dict]) -> list[dict]:
+    if not items:
+        return []
+    response = _post(url, {"items": items})
+    response.raise_for_status()
+    return response.json()["results"]
+
+
+def _batch_error(result: dict) -> str:
+    if result.get("details"):
+        return f"{result['error']}: {result['details']}"
+    return result.get("error", "unknown error")
+
+
+def process_messages_batch(
+    message_infos: list[dict],
+    decrypt_message: bool = True,
+    decode_message: bool = True,
+    ttn_only: bool = True,
+) -> list[dict]:
+    """process_message for many messages, one decoder API call per step.
+
+    The results are in the order of message_infos. A message the decoder
+    API fails on lacks decryptedPayload or decodedPayload, as with
+    process_message, and carries the reason in processingError. Errors of
+    the whole request raise like the single calls.
+    """
+    sessions = [
+        _attach_session(_message_info, ttn_only)
+        for _message_info in message_infos
+    ]
+    if decrypt_message:
+        _pending = [
+            (_message_info, _session)
+            for _message_info, _session in zip(message_infos, sessions)
+            if _session
+        ]
+        if DECRYPTER == "python":
+            for _message_info, _session in _pending:
+                _decrypted = _decrypt_message(
+                    _message_info["rawMessage"], _session
+                )
+                if _decrypted:
+                    _message_info["decryptedPayload"] = _decrypted
+        else:
+            _results = _post_batch(
+                f"{BASE_URL}/decrypt/batch",
+                [
+                    {
+                        "payload": _message_info["rawMessage"],
+                        "app_s_key": _session["app_s_key"],
+                        "nwk_s_key": _session["nwk_s_key"],
+                    }
+                    for _message_info, _session in _pending
+                ],
+            )
+            for (_message_info, _), _result in zip(_pending, _results):
+                if "error" in _result:
+                    _message_info["processingError"] = _batch_error(_result)
+                elif _result.get("result"):
+                    _message_info["decryptedPayload"] = _result["result"]
+
+    if decode_message:
+        _pending = []
+        for _message_info, _session in zip(message_infos, sessions):
+            if not _session or "decryptedPayload" not in _message_info:
+                continue
+            _decoded = decode_cache.get(
+                _decode_key(_message_info["decryptedPayload"], _message_info)
+            )
+            if _decoded is not None:
+                _message_info["decodedPayload"] = _decoded
+            else:
+                _pending.append(_message_info)
+        _results = _post_batch(
+            f"{BASE_URL}/decode/batch",
+            [
+                {
+                    "payload": _message_info["decryptedPayload"],
+                    "application": _message_info["applicationId"],
+                    "device": _message_info["deviceId"],
+                    "fPort": _message_info["fPort"],
+                }
+                for _message_info in _pending
+            ],
+        )
+        for _message_info, _result in zip(_pending, _results):
+            if "error" in _result:
+                _message_info["processingError"] = _batch_error(_result)
+            elif _result.get("result"):
+                _message_info["decodedPayload"] = _result["result"]
+                decode_cache.put(
+                    _decode_key(
+                        _message_info["decryptedPayload"], _message_info
+                    ),
+                    _result["result"],
+                )
+
+    return message_infos
+
+
+def _process_combined(
+    raw_message: str,
+    message_format: Literal["hex", "base64"],
+    session_info: dict,
+) -> dict:
+    process_url = f"{BASE_URL}/process/{message_format}"
+    response = _post(
+        process_url,
+        {
+            "payload": raw_message,
+            "app_s_key": session_info["app_s_key"],
+            "nwk_s_key": session_info["nwk_s_key"],
+            "application": session_info["application_id"],
+            "device": session_info["device_id"],
+        },
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def _decode_cached(message_info: dict, session_info: dict) -> bool:
+    """Fills in a cached decode result for the combined mode.
+
+    Only with DECRYPTER=python: the frame is decrypted locally, and on a
+    cache hit the /process call is skipped altogether.
+    """
+    if DECRYPTER != "python" or decode_cache.maxsize <= 0:
+        return False
+    decrypted_payload = _decrypt_message(
+        message_info["rawMessage"], session_info
+    )
+    if not decrypted_payload:
+        return False
+    decoded_payload = decode_cache.get(
+        _decode_key(decrypted_payload, message_info)
+    )
+    if decoded_payload is None:
+        return False
+    message_info["decryptedPayload"] = decrypted_payload
+    message_info["decodedPayload"] = decoded_payload
+    return True
+
+
 def process_raw_message(
     raw_message: str,
     message_format: Literal["hex", "base64"] = "hex",
@@ -104,6 +435,23 @@ def process_raw_message(
     decode_message: bool = True,
     ttn_only: bool = True,
 ) -> dict:
+    if DECODER_MODE == "combined" and decrypt_message and decode_message:
+        # the session lookup only needs the DevAddr, parsed locally
+        message_info = lorawan_frame.parse_raw_message(
+            raw_message, message_format
+        )
+        session_info = _attach_session(message_info, ttn_only)
+        if session_info and not _decode_cached(message_info, session_info):
+            message_info.update(
+                _process_combined(raw_message, message_format, session_info)
+            )
+            decoded_payload = message_info.get("decodedPayload")
+            if decoded_payload and "decryptedPayload" in message_info:
+                key = _decode_key(
+                    message_info["decryptedPayload"], message_info
+                )
+                decode_cache.put(key, decoded_payload)
+        return message_info
     return process_message(
         message_info=_fetch_message_info(raw_message, message_format),
         decrypt_message=decrypt_message,
@@ -5,8 +5,11 @@ const lora_packet = require("lora-packet");
 
 const app = express();
 const port = process.env.PORT || 3000;
+// Unix domain socket path, used instead of the TCP port if set
+const socketPath = process.env.SOCKET_PATH;
 
-app.use(express.json());
+// batch requests carry hundreds of frames
+app.use(express.json({ limit: '10mb' }));
 
 const ERROR_MESSAGES = {
     MISSING_FIELDS: 'Invalid input. Required fields are missing.',
@@ -42,51 +45,112 @@ async function loadDecoder(application, device) {
     }
 }
 
-async function decodePayload(req, res, format) {
-    const { application, device, payload, fPort } = req.body;
-
-    const validationError = validateFields(['application', 'device', 'payload', 'fPort'], req.body);
-    if (validationError) {
-        return sendError(res, 400, validationError);
-    }
-
+async function decodeBytes(application, device, bytes, fPort) {
     try {
         const decoder = await loadDecoder(application, device);
-        const bytes = Buffer.from(payload, format);
         const input = {
             bytes: Array.from(bytes),
             fPort
         };
-        const result = decoder.decodeUplink(input);
-        res.json(result);
+        return { result: decoder.decodeUplink(input) };
     } catch (error) {
-        sendError(res, 500, ERROR_MESSAGES.DECODING_FAILED, error.message);
+        return { status: 500, error: ERROR_MESSAGES.DECODING_FAILED, details: error.message };
     }
 }
 
-function decryptPayload(req, res, format) {
-    const { payload, app_s_key, nwk_s_key } = req.body;
+// Decodes one item; returns { result } or { status, error, details }.
+async function decodeItem(item, format) {
+    const { application, device, payload, fPort } = item;
 
-    const validationError = validateFields(['payload', 'app_s_key', 'nwk_s_key'], req.body);
+    const validationError = validateFields(['application', 'device', 'payload', 'fPort'], item);
     if (validationError) {
-        return sendError(res, 400, validationError);
+        return { status: 400, error: validationError };
     }
 
+    return decodeBytes(application, device, Buffer.from(payload, format), fPort);
+}
+
+function decryptPacket(packet, app_s_key, nwk_s_key) {
     try {
-        const bytes = Buffer.from(payload, format);
-        const packet = lora_packet.fromWire(bytes);
         const AppSKey = Buffer.from(app_s_key, 'hex');
         const NwkSKey = Buffer.from(nwk_s_key, 'hex');
 
         if (!lora_packet.verifyMIC(packet, NwkSKey)) {
-            return sendError(res, 400, ERROR_MESSAGES.INVALID_MIC);
+            return { status: 400, error: ERROR_MESSAGES.INVALID_MIC };
         }
 
-        const decryptedPayload = lora_packet.decrypt(packet, AppSKey, NwkSKey);
-        res.json(decryptedPayload.toString('hex'));
+        return { result: lora_packet.decrypt(packet, AppSKey, NwkSKey) };
     } catch (error) {
-        sendError(res, 500, ERROR_MESSAGES.DECRYPTION_FAILED, error.message);
+        return { status: 500, error: ERROR_MESSAGES.DECRYPTION_FAILED, details: error.message };
+    }
+}
+
+// Decrypts one item; returns { result } or { status, error, details }.
+function decryptItem(item, format) {
+    const { payload, app_s_key, nwk_s_key } = item;
+
+    const validationError = validateFields(['payload', 'app_s_key', 'nwk_s_key'], item);
+    if (validationError) {
+        return { status: 400, error: validationError };
+    }
+
+    let packet;
+    try {
+        packet = lora_packet.fromWire(Buffer.from(payload, format));
+    } catch (error) {
+        return { status: 500, error: ERROR_MESSAGES.DECRYPTION_FAILED, details: error.message };
+    }
+    const outcome = decryptPacket(packet, app_s_key, nwk_s_key);
+    if (outcome.error) return outcome;
+    return { result: outcome.result.toString('hex') };
+}
+
+function sendItem(res, outcome) {
+    if (outcome.error) {
+        return sendError(res, outcome.status, outcome.error, outcome.details);
+    }
+    res.json(outcome.result);
+}
+
+async function decodePayload(req, res, format) {
+    sendItem(res, await decodeItem(req.body, format));
+}
+
+function decryptPayload(req, res, format) {
+    sendItem(res, decryptItem(req.body, format));
+}
+
+// Batch endpoints: { items: [...] } → { results: [...] } in the same order,
+// each result being { result } or { error, details } for that item.
+async function processBatch(req, res, processItem) {
+    const { items } = req.body;
+    if (!Array.isArray(items)) {
+        return sendError(res, 400, ERROR_MESSAGES.MISSING_FIELDS, 'items must be an array');
+    }
+    const format = req.body.format === 'base64' ? 'base64' : 'hex';
+    const results = [];
+    for (const item of items) {
+        const { status, ...outcome } = await processItem(item || {}, format);
+        results.push(outcome);
     }
+    res.json({ results });
+}
+
+function describePacket(packet, bytes) {
+    return {
+        rawMessage: bytes.toString('hex'),
+        devAddr: packet.DevAddr?.toString('hex'),
+        fPort: packet.getFPort?.(),
+        fCnt: packet.getFCnt?.(),
+        mic: packet.MIC?.toString('hex'),
+        mType: packet.getMType?.(),
+        direction: packet.getDir?.() === 'up' ? 'uplink' : 'downlink',
+        frmPayload: packet.FRMPayload?.toString('hex'),
+        macPayload: packet.MACPayload?.toString('hex'),
+        fCtrl: packet.FCtrl?.toString('hex'),
+        fOpts: packet.FOpts?.toString('hex'),
+        mhdr: packet.MHDR?.toString('hex')
+    };
 }
 
 function extractMessageInfo(req, res, format) {
@@ -101,38 +165,80 @@ function extractMessageInfo(req, res, format) {
         const bytes = Buffer.from(payload, format);
         const packet = lora_packet.fromWire(bytes);
         // console.log("Packet structure:", JSON.stringify(packet, null, 2));
-        const messageInfo = {
-            rawMessage: bytes.toString('hex'),
-            devAddr: packet.DevAddr?.toString('hex'),
-            fPort: packet.getFPort?.(),
-            fCnt: packet.getFCnt?.(),
-            mic: packet.MIC?.toString('hex'),
-            mType: packet.getMType?.(),
-            direction: packet.getDir?.() === 0 ? 'uplink' : 'downlink',
-            frmPayload: packet.FRMPayload?.toString('hex'),
-            macPayload: packet.MACPayload?.toString('hex'),
-            fCtrl: packet.FCtrl?.toString('hex'),
-            fOpts: packet.FOpts?.toString('hex'),
-            mhdr: packet.MHDR?.toString('hex')
-        };
-
-        res.json(messageInfo);
+        res.json(describePacket(packet, bytes));
     } catch (error) {
         sendError(res, 500, 'Failed to extract message information.', error.message);
     }
 }
 
+// Info, decrypt and decode of one frame in a single call: the frame is
+// parsed once and the messageInfo is returned with decryptedPayload and
+// decodedPayload added as far as they succeed.
+async function processFrame(req, res, format) {
+    const { payload, app_s_key, nwk_s_key, application, device } = req.body;
+
+    const validationError = validateFields(
+        ['payload', 'app_s_key', 'nwk_s_key', 'application', 'device'], req.body
+    );
+    if (validationError) {
+        return sendError(res, 400, validationError);
+    }
+
+    let bytes, packet;
+    try {
+        bytes = Buffer.from(payload, format);
+        packet = lora_packet.fromWire(bytes);
+    } catch (error) {
+        return sendError(res, 500, 'Failed to extract message information.', error.message);
+    }
+    const messageInfo = describePacket(packet, bytes);
+
+    const decrypted = decryptPacket(packet, app_s_key, nwk_s_key);
+    if (decrypted.error) {
+        console.error(`Error: ${decrypted.error}`, decrypted.details ? `Details: ${decrypted.details}` : '');
+        return res.json(messageInfo);
+    }
+    if (decrypted.result.length === 0) {
+        return res.json(messageInfo);
+    }
+    messageInfo.decryptedPayload = decrypted.result.toString('hex');
+
+    if (!messageInfo.fPort) {
+        return res.json(messageInfo);
+    }
+    const decoded = await decodeBytes(application, device, decrypted.result, messageInfo.fPort);
+    if (decoded.error) {
+        console.error(`Error: ${decoded.error}`, decoded.details ? `Details: ${decoded.details}` : '');
+    } else if (decoded.result) {
+        messageInfo.decodedPayload = decoded.result;
+    }
+    res.json(messageInfo);
+}
+
 app.post('/decode/hex', (req, res) => decodePayload(req, res, 'hex'));
 app.post('/decode/base64', (req, res) => decodePayload(req, res, 'base64'));
 app.post('/decrypt/hex', (req, res) => decryptPayload(req, res, 'hex'));
 app.post('/decrypt/base64', (req, res) => decryptPayload(req, res, 'base64'));
+app.post('/decode/batch', (req, res) => processBatch(req, res, decodeItem));
+app.post('/decrypt/batch', (req, res) => processBatch(req, res, decryptItem));
 app.post('/info/hex', (req, res) => extractMessageInfo(req, res, 'hex'));
 app.post('/info/base64', (req, res) => extractMessageInfo(req, res, 'base64'));
+app.post('/process/hex', (req, res) => processFrame(req, res, 'hex'));
+app.post('/process/base64', (req, res) => processFrame(req, res, 'base64'));
 
-app.listen(port, (err) => {
+if (socketPath) {
+    // remove the socket file left behind by a previous run
+    fs.rmSync(socketPath, { force: true });
+}
+
+app.listen(socketPath || port, (err) => {
     if (err) {
         console.error(`Failed to start server: ${err.message}`);
         process.exit(1);
     }
-    console.log(`Decoder API listening at http://localhost:${port}`);
+    if (socketPath) {
+        console.log(`Decoder API listening on ${socketPath}`);
+    } else {
+        console.log(`Decoder API listening at http://localhost:${port}`);
+    }
 });
@@ -3,8 +3,9 @@
 
 import json
 import logging
+import os
 import sqlite3
-from requests import HTTPError
+from requests import RequestException
 import message_processor
 from message_database import DB_NAME
 
@@ -26,29 +27,49 @@ UPDATE_SQL = """
 """
 
 
+# messages sent to the decoder API per batch request
+BATCH_SIZE = int(os.environ.get("REPROCESS_BATCH_SIZE", 200))
+
+
 def reprocess():
     with sqlite3.connect(DB_NAME) as conn:
         rows = conn.execute(SELECT_SQL).fetchall()
 
         updated = 0
         skipped = 0
-        for timestamp, gateway_eui, payload_str in rows:
-            message_info = json.loads(payload_str)
+        for _start in range(0, len(rows), BATCH_SIZE):
+            _rows = rows[_start : _start + BATCH_SIZE]
+            message_infos = [json.loads(_row[2]) for _row in _rows]
             try:
-                enriched = message_processor.process_message(message_info)
-            except HTTPError as e:
-                log.warning("HTTP error for timestamp=%s: %s", timestamp, e)
-                skipped += 1
+                enriched_messages = message_processor.process_messages_batch(
+                    message_infos
+                )
+            except RequestException as e:
+                log.warning(
+                    "HTTP error for timestamps %s to %s: %s",
+                    _rows[0][0],
+                    _rows[-1][0],
+                    e,
+                )
+                skipped += len(_rows)
                 continue
 
-            if enriched.get("deviceId") is None:
-                skipped += 1
-                continue
+            for (timestamp, gateway_eui, _), enriched in zip(
+                _rows, enriched_messages
+            ):
+                error = enriched.pop("processingError", None)
+                if error is not None:
+                    log.warning(
+                        "Decoder error for timestamp=%s: %s", timestamp, error
+                    )
+                if enriched.get("deviceId") is None:
+                    skipped += 1
+                    continue
 
-            conn.execute(
-                UPDATE_SQL, (json.dumps(enriched), timestamp, gateway_eui)
-            )
-            updated += 1
+                conn.execute(
+                    UPDATE_SQL, (json.dumps(enriched), timestamp, gateway_eui)
+                )
+                updated += 1
 
         conn.commit()
         if updated > 0:
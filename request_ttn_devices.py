@@ -1,8 +1,10 @@
 #!venv/bin/python3
 import sqlite3
 import requests
+import redis
 import os
 from dotenv import load_dotenv
+from device_database import SESSIONS_UPDATED_CHANNEL
 
 load_dotenv()
 bearer_token = os.getenv("TTN_TOKEN")
@@ -15,6 +17,8 @@ session = requests.Session()
 session.headers.update({"Authorization": f"Bearer {bearer_token}"})
 API_URL = "https://eu1.cloud.thethings.network/api/v3"
 DB_FILE = os.path.join(os.getenv("DB_DIR", "."), "ttn_device_sessions.db")
+redis_host = os.environ.get("REDIS_HOST", "127.0.0.1")
+redis_port = int(os.environ.get("REDIS_PORT", 6379))
 
 
 def initialize_database():
@@ -166,3 +170,11 @@ for _application_id in application_ids:
             nwk_s_key,
             up_formatter,
         )
+
+# let running message handlers reload their session index
+try:
+    redis.Redis(host=redis_host, port=redis_port).publish(
+        SESSIONS_UPDATED_CHANNEL, DB_FILE
+    )
+except redis.RedisError as e:
+    print(f"Could not notify message handlers: {e}")
@@ -26,7 +26,6 @@ Configuration via environment variables (or .env file):
 """
 import json
 import logging
-import sqlite3
 import time
 from datetime import datetime, timezone
 from typing import Any
@@ -63,7 +62,7 @@ API_BASE = os.getenv(
 ).rstrip("/")
 STORAGE_LAST = os.getenv("TTN_STORAGE_LAST", "44h")
 
-from message_database import DB_NAME, create_database
+from message_database import MessageWriter, create_database
 
 
 def _parse_timestamp(received_at: str) -> float:
@@ -74,7 +73,9 @@ def _parse_timestamp(received_at: str) -> float:
     )
 
 
-def insert_messages(messages: list[dict[str, Any]], application_id: str) -> int:
+def insert_messages(
+    writer: MessageWriter, messages: list[dict[str, Any]], application_id: str
+) -> int:
     rows = []
     for msg in messages:
         try:
@@ -90,15 +91,7 @@ def insert_messages(messages: list[dict[str, Any]], application_id: str) -> int:
     if not rows:
         return 0
 
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.executemany(
-            """
-            INSERT OR REPLACE INTO ttn_storage_messages
-                (time, application_id, device_id, data)
-            VALUES (?, ?, ?, ?)
-            """,
-            rows,
-        )
+    writer.insert_storage_messages(rows)
     return len(rows)
 
 
@@ -157,11 +150,12 @@ def fetch_messages(application_id: str) -> list[dict[str, Any]]:
 
 if __name__ == "__main__":
     create_database()
-    for app_id in APPLICATION_IDS:
-        log.info("Fetching messages for application: %s", app_id)
-        messages = fetch_messages(app_id)
-        if messages:
-            count = insert_messages(messages, app_id)
-            log.info("Stored %d messages for %s", count, app_id)
-        else:
-            log.info("No messages received for %s", app_id)
+    with MessageWriter() as writer:
+        for app_id in APPLICATION_IDS:
+            log.info("Fetching messages for application: %s", app_id)
+            messages = fetch_messages(app_id)
+            if messages:
+                count = insert_messages(writer, messages, app_id)
+                log.info("Stored %d messages for %s", count, app_id)
+            else:
+                log.info("No messages received for %s", app_id)
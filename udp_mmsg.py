@@ -0,0 +1,192 @@
+"""
+udp_mmsg.py – batched UDP I/O via the Linux recvmmsg/sendmmsg system calls
+
+The socket module has no multi-message API, so the calls are made through
+ctypes on the libc symbols. Only IPv4 (AF_INET) datagram sockets are
+supported, which is all gwmp_mux uses. AVAILABLE is False on platforms
+without these calls; callers are expected to fall back to recvfrom/sendto.
+"""
+
+import ctypes
+import ctypes.util
+import functools
+import os
+import socket
+import struct
+
+MSG_WAITFORONE = 0x10000
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),  # network byte order
+        ("sin_addr", ctypes.c_uint8 * 4),
+        ("sin_zero", ctypes.c_uint8 * 8),
+    ]
+
+
+def _load_libc():
+    if not hasattr(socket, "MSG_DONTWAIT"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.recvmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(_MMsgHdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        libc.sendmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(_MMsgHdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+        ]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+AVAILABLE = _libc is not None
+
+_SOCKADDR_LEN = ctypes.sizeof(_SockAddrIn)
+
+
+def _os_error() -> OSError:
+    # OSError picks the matching subclass, e.g. BlockingIOError for EAGAIN.
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+
+@functools.lru_cache(maxsize=1024)
+def _sockaddr(addr: tuple) -> bytes:
+    """Packed sockaddr_in for an (ip, port) address.
+
+    Host names are not resolved here; callers pass resolved addresses (see
+    gwmp_mux.Upstream), anything else fails with OSError.
+    """
+    ip, port = addr
+    return struct.pack(
+        "=H2s4s8x",
+        socket.AF_INET,
+        struct.pack("!H", port),
+        socket.inet_aton(ip),
+    )
+
+
+class MessageReceiver:
+    """Receives up to `count` datagrams per recvmmsg call into fixed buffers."""
+
+    def __init__(self, sock: socket.socket, count: int, bufsize: int) -> None:
+        self._sock = sock
+        self._count = count
+        self._buffers = [
+            ctypes.create_string_buffer(bufsize) for _ in range(count)
+        ]
+        self._iovecs = (_IOVec * count)()
+        self._addrs = (_SockAddrIn * count)()
+        self._msgs = (_MMsgHdr * count)()
+        for i in range(count):
+            self._iovecs[i].iov_base = ctypes.addressof(self._buffers[i])
+            self._iovecs[i].iov_len = bufsize
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i])
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, flags: int = 0) -> list[tuple[bytes, tuple]]:
+        """Return all pending datagrams as (data, (ip, port)) tuples.
+
+        With MSG_WAITFORONE the call blocks until at least one datagram is
+        available, with MSG_DONTWAIT it raises BlockingIOError if none is.
+        """
+        for i in range(self._count):
+            self._msgs[i].msg_hdr.msg_namelen = _SOCKADDR_LEN
+        received = _libc.recvmmsg(
+            self._sock.fileno(), self._msgs, self._count, flags, None
+        )
+        if received < 0:
+            raise _os_error()
+        packets = []
+        for i in range(received):
+            addr = self._addrs[i]
+            packets.append(
+                (
+                    ctypes.string_at(self._buffers[i], self._msgs[i].msg_len),
+                    (
+                        socket.inet_ntoa(bytes(addr.sin_addr)),
+                        socket.ntohs(addr.sin_port),
+                    ),
+                )
+            )
+        return packets
+
+
+def sendmmsg(
+    sock: socket.socket, messages: list[tuple[bytes, tuple]], flags: int = 0
+) -> list[tuple[int, OSError]]:
+    """Send (data, addr) datagrams with as few sendmmsg calls as possible.
+
+    A datagram that cannot be sent is skipped; the returned list holds the
+    index and error of every such datagram.
+    """
+    failures = []
+    prepared = []  # (index, data, packed address)
+    for index, (data, addr) in enumerate(messages):
+        try:
+            prepared.append((index, data, _sockaddr(addr)))
+        except OSError as exc:
+            failures.append((index, exc))
+
+    count = len(prepared)
+    msgs = (_MMsgHdr * count)()
+    iovecs = (_IOVec * count)()
+    keep = []  # keeps the buffers referenced by the headers alive
+    for i, (_, data, name) in enumerate(prepared):
+        buf = ctypes.create_string_buffer(data, len(data))
+        name_buf = ctypes.create_string_buffer(name, _SOCKADDR_LEN)
+        keep.append((buf, name_buf))
+        iovecs[i].iov_base = ctypes.addressof(buf)
+        iovecs[i].iov_len = len(data)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.addressof(name_buf)
+        hdr.msg_namelen = _SOCKADDR_LEN
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+
+    fd = sock.fileno()
+    sent = 0
+    while sent < count:
+        result = _libc.sendmmsg(
+            fd, ctypes.byref(msgs[sent]), count - sent, flags
+        )
+        if result < 0:
+            # The datagram at `sent` failed – report it and carry on.
+            failures.append((prepared[sent][0], _os_error()))
+            sent += 1
+        else:
+            sent += result
+    return failures